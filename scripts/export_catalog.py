@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Instagram Image Service - Catalog Export
+Stream the images table to S3 as NDJSON (gzip by default) with a parallel scan
+"""
+import argparse
+import json
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lambda_handler import export_catalog, export_status, start_export  # noqa: E402
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# LocalStack configuration
+ENDPOINT_URL = 'http://localhost:4566'
+REGION = 'us-east-1'
+AWS_ACCESS_KEY_ID = 'test'
+AWS_SECRET_ACCESS_KEY = 'test'
+
+def _session_kwargs():
+    return dict(
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=REGION
+    )
+
+def export_segment(s3_client, export_id, segment, total_segments, compress):
+    """Export one scan segment with its own DynamoDB resource (resources are not thread-safe)"""
+    dynamodb = boto3.session.Session().resource('dynamodb', **_session_kwargs())
+    state = export_catalog(dynamodb, s3_client, export_id, segment, total_segments, compress)
+    logger.info(f"Segment {segment}: {state['items']} items in {len(state['parts'])} parts -> {state['key']}")
+    return state
+
+def main():
+    """Run or resume one export"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--export-id', help='resume this export instead of starting a new one')
+    parser.add_argument('--segments', type=int, default=4, help='parallel scan segments (new exports only)')
+    parser.add_argument('--no-gzip', action='store_true', help='write plain NDJSON')
+    args = parser.parse_args()
+
+    s3_client = boto3.client('s3', **_session_kwargs())
+
+    if args.export_id:
+        status = export_status(s3_client, args.export_id)
+        if status is None:
+            logger.error(f"❌ Unknown export {args.export_id}")
+            return False
+        logger.info(f"Resuming export {args.export_id}")
+    else:
+        status = start_export(s3_client, max(args.segments, 1), not args.no_gzip)
+        logger.info(f"Started export {status['export_id']}")
+
+    with ThreadPoolExecutor(max_workers=status['total_segments']) as pool:
+        futures = [
+            pool.submit(export_segment, s3_client, status['export_id'], segment,
+                        status['total_segments'], status['compress'])
+            for segment in range(status['total_segments'])
+        ]
+        for future in futures:
+            future.result()
+
+    status = export_status(s3_client, status['export_id'])
+    logger.info(f"✅ Exported {status['items']} items to s3://instagram-images/exports/{status['export_id']}/")
+    print(json.dumps(status, indent=2))
+    return True
+
+if __name__ == '__main__':
+    success = main()
+    if not success:
+        exit(1)
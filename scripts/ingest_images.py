@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Instagram Image Service - Bulk Ingest
+Backfill a directory or manifest of images with concurrent uploads and batched metadata writes
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lambda_handler import (  # noqa: E402
+    build_image_item, image_content_type, release_image_blob, store_image_blob, update_image_counters
+)
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# LocalStack configuration
+ENDPOINT_URL = 'http://localhost:4566'
+REGION = 'us-east-1'
+AWS_ACCESS_KEY_ID = 'test'
+AWS_SECRET_ACCESS_KEY = 'test'
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+BATCH_SIZE = 25  # BatchWriteItem limit
+
+_local = threading.local()
+
+def clients():
+    """DynamoDB resource and S3 client for the current thread (resources are not thread-safe)"""
+    if not hasattr(_local, 'dynamodb'):
+        session = boto3.session.Session()
+        kwargs = dict(
+            endpoint_url=ENDPOINT_URL,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=REGION
+        )
+        _local.dynamodb = session.resource('dynamodb', **kwargs)
+        _local.s3 = session.client('s3', **kwargs)
+    return _local.dynamodb, _local.s3
+
+class RateLimiter:
+    """Token bucket of DynamoDB writes per second, shared by all threads"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        cost = min(cost, self.rate)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            time.sleep(wait)
+
+def table_write_rate(dynamodb, table_name, share, fallback):
+    """Writes per second to allow on a table: a share of its provisioned WCU, or fallback when on-demand"""
+    table = dynamodb.meta.client.describe_table(TableName=table_name)['Table']
+    wcu = table.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    return max(wcu * share, 1) if wcu else fallback
+
+def iter_sources(args):
+    """Yield {'path', 'user_id', 'filename', 'tags', 'description', 'upload_date'} records"""
+    if args.manifest:
+        base = os.path.dirname(os.path.abspath(args.manifest))
+        with open(args.manifest) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record['path'] = os.path.join(base, record['path'])
+                record.setdefault('user_id', args.user_id)
+                record.setdefault('filename', os.path.basename(record['path']))
+                yield record
+        return
+    for root, dirs, files in os.walk(args.directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield {
+                    'path': os.path.join(root, name),
+                    'user_id': args.user_id,
+                    'filename': name,
+                    'tags': args.tags
+                }
+
+def load_checkpoint(path):
+    """Source paths finished by earlier runs"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.loads(line)['path'] for line in f if line.strip())
+
+def ingest_one(source, limiters):
+    """Store one file's bytes and build its metadata item; runs on a worker thread"""
+    dynamodb, s3_client = clients()
+    # Stable per source file, so a rerun after a crash finds what it already wrote
+    image_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"ingest:{os.path.abspath(source['path'])}"))
+    limiters['images'].acquire(0.5)
+    existing = dynamodb.Table('images').get_item(Key={'image_id': image_id}, ProjectionExpression='image_id')
+    if existing.get('Item'):
+        return source, None
+
+    with open(source['path'], 'rb') as f:
+        image_data = f.read()
+    limiters['image_blobs'].acquire(2)
+    s3_key, content_hash, _ = store_image_blob(
+        dynamodb.Table('image_blobs'), s3_client, image_data, image_content_type(source['filename'])
+    )
+    item = build_image_item(
+        image_id, source['user_id'], source['filename'], image_data, s3_key, content_hash,
+        source.get('upload_date') or datetime.now().isoformat(),
+        source.get('tags') or [], source.get('description', '')
+    )
+    return source, item
+
+def write_batch(batch, limiters, checkpoint):
+    """Write a batch of items, then their counters, then record them as done"""
+    dynamodb, s3_client = clients()
+    items = [item for _, item in batch if item]
+    limiters['images'].acquire(len(items))
+    try:
+        with dynamodb.Table('images').batch_writer() as writer:
+            for item in items:
+                writer.put_item(Item=item)
+    except Exception:
+        for item in items:
+            release_image_blob(dynamodb.Table('image_blobs'), s3_client, item['content_hash'])
+        raise
+
+    stats_table = dynamodb.Table('image_stats')
+    for item in items:
+        tags = set(item['tags'])
+        limiters['image_stats'].acquire(1 + (len(tags) + 2 if tags else 0))
+        update_image_counters(stats_table, item['user_id'], item['tags'], 1)
+
+    for source, item in batch:
+        checkpoint.write(json.dumps({'path': source['path'], 'image_id': item and item['image_id']}) + '\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+def main():
+    """Ingest every source not already in the checkpoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--directory', help='walk this directory for image files')
+    source.add_argument('--manifest', help='JSON lines with path (relative to the manifest), user_id, '
+                                           'tags, description, upload_date')
+    parser.add_argument('--user-id', help='owner for directory sources and manifest lines without one')
+    parser.add_argument('--tags', type=lambda value: [t for t in value.split(',') if t], default=[],
+                        help='comma-separated tags for directory sources')
+    parser.add_argument('--checkpoint', default='ingest-checkpoint.jsonl', help='progress file for resuming')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent uploads')
+    parser.add_argument('--capacity-share', type=float, default=0.5,
+                        help='fraction of each table\'s provisioned WCU to use')
+    parser.add_argument('--max-writes-per-second', type=float, default=200,
+                        help='write rate per table when it is on-demand')
+    args = parser.parse_args()
+    if args.directory and not args.user_id:
+        parser.error('--user-id is required with --directory')
+
+    dynamodb, _ = clients()
+    limiters = {
+        name: RateLimiter(table_write_rate(dynamodb, name, args.capacity_share, args.max_writes_per_second))
+        for name in ('images', 'image_blobs', 'image_stats')
+    }
+    for name, limiter in limiters.items():
+        logger.info(f"Rate limit for {name}: {limiter.rate:g} writes/s")
+
+    done = load_checkpoint(args.checkpoint)
+    counts = {'ingested': 0, 'already_present': 0, 'skipped': 0, 'failed': 0}
+    started = time.time()
+
+    with open(args.checkpoint, 'a') as checkpoint, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        in_flight = deque()
+        batch = []
+        next_report = 1000
+
+        def drain(limit):
+            while len(in_flight) > limit:
+                future_source, future = in_flight.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    counts['failed'] += 1
+                    logger.error(f"❌ {future_source['path']}: {e}")
+                    continue
+                counts['ingested' if result[1] else 'already_present'] += 1
+                batch.append(result)
+                if len(batch) >= BATCH_SIZE:
+                    write_batch(batch, limiters, checkpoint)
+                    batch.clear()
+
+        for record in iter_sources(args):
+            if record['path'] in done:
+                counts['skipped'] += 1
+                continue
+            # Bounded look-ahead keeps memory flat for archives of any size
+            in_flight.append((record, pool.submit(ingest_one, record, limiters)))
+            drain(args.workers * 4)
+            processed = counts['ingested'] + counts['already_present']
+            if processed >= next_report:
+                logger.info(f"… {processed} images, {processed / (time.time() - started):.1f}/s")
+                next_report += 1000
+        drain(0)
+        if batch:
+            write_batch(batch, limiters, checkpoint)
+
+    elapsed = time.time() - started
+    logger.info(f"✅ Ingested {counts['ingested']} images in {elapsed:.1f}s, "
+                f"{counts['already_present']} already present, {counts['skipped']} skipped by checkpoint, "
+                f"{counts['failed']} failed")
+    print(json.dumps(dict(counts, seconds=round(elapsed, 1)), indent=2))
+    return counts['failed'] == 0
+
+if __name__ == '__main__':
+    success = main()
+    if not success:
+        exit(1)
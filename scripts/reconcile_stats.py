@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Instagram Image Service - Counter Reconciliation
+Recount images per user and tag and repair drifted counters in image_stats
+"""
+import argparse
+import json
+import os
+import sys
+import logging
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lambda_handler import reconcile_stats  # noqa: E402
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# LocalStack configuration
+ENDPOINT_URL = 'http://localhost:4566'
+REGION = 'us-east-1'
+AWS_ACCESS_KEY_ID = 'test'
+AWS_SECRET_ACCESS_KEY = 'test'
+
+def main():
+    """Run one reconciliation pass"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dry-run', action='store_true', help='report drift without writing')
+    args = parser.parse_args()
+    
+    dynamodb = boto3.resource(
+        'dynamodb',
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=REGION
+    )
+    
+    result = reconcile_stats(dynamodb, dry_run=args.dry_run)
+    for fix in result['fixed']:
+        logger.info(f"{'Would fix' if args.dry_run else 'Fixed'} {fix['stat_key']}: "
+                    f"{fix['observed']} -> {fix['expected']}")
+    for drift in result['pending']:
+        logger.info(f"Drift on {drift['stat_key']} ({drift['attribute']}): "
+                    f"{drift['observed']} vs {drift['expected']}, fixed if the next run sees it too")
+    logger.info(f"✅ Checked {result['images_checked']} images, "
+                f"{len(result['fixed'])} counters drifted, {len(result['pending'])} pending, "
+                f"{result['skipped']} skipped (changed concurrently)")
+    print(json.dumps(result, indent=2))
+    return True
+
+if __name__ == '__main__':
+    success = main()
+    if not success:
+        exit(1)
@@ -56,6 +56,12 @@ def setup_s3():
         logger.error(f"❌ S3 setup failed: {e}")
         return False
 
+# Supporting tables keyed by a single string attribute
+AUX_TABLES = {
+    'image_blobs': 'content_hash',  # reference counts for content-addressed S3 objects
+    'image_stats': 'stat_key'       # per-user and per-tag image counters
+}
+
 def setup_dynamodb():
     """Create DynamoDB table for image metadata"""
     try:
@@ -74,7 +80,8 @@ def setup_dynamodb():
                 AttributeDefinitions=[
                     {'AttributeName': 'image_id', 'AttributeType': 'S'},
                     {'AttributeName': 'user_id', 'AttributeType': 'S'},
-                    {'AttributeName': 'upload_date', 'AttributeType': 'S'}
+                    {'AttributeName': 'upload_date', 'AttributeType': 'S'},
+                    {'AttributeName': 'upload_day', 'AttributeType': 'S'}
                 ],
                 GlobalSecondaryIndexes=[{
                     'IndexName': 'user-upload-date-index',
@@ -84,6 +91,15 @@ def setup_dynamodb():
                     ],
                     'Projection': {'ProjectionType': 'ALL'},
                     'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+                }, {
+                    # Sparse: only images with a perceptual hash carry upload_day
+                    'IndexName': 'phash-day-index',
+                    'KeySchema': [
+                        {'AttributeName': 'upload_day', 'KeyType': 'HASH'},
+                        {'AttributeName': 'upload_date', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['phash']},
+                    'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
                 }],
                 ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
             )
@@ -92,6 +108,30 @@ def setup_dynamodb():
         except Exception as e:
             if 'ResourceInUseException' in str(e):
                 logger.info("✅ DynamoDB table already exists")
+        
+        for table_name, key_name in AUX_TABLES.items():
+            try:
+                table = dynamodb.create_table(
+                    TableName=table_name,
+                    KeySchema=[{'AttributeName': key_name, 'KeyType': 'HASH'}],
+                    AttributeDefinitions=[{'AttributeName': key_name, 'AttributeType': 'S'}],
+                    ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+                )
+                table.wait_until_exists()
+                logger.info(f"✅ Created DynamoDB table: {table_name}")
+            except Exception as e:
+                if 'ResourceInUseException' in str(e):
+                    logger.info(f"✅ DynamoDB table {table_name} already exists")
+        
+        # Hourly tagrecent#{hour}#{n} sets expire on their own
+        try:
+            dynamodb.meta.client.update_time_to_live(
+                TableName='image_stats',
+                TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires_at'}
+            )
+        except Exception as e:
+            if 'already enabled' not in str(e):
+                logger.warning(f"⚠️  Could not enable TTL on image_stats: {e}")
         return True
     except Exception as e:
         logger.error(f"❌ DynamoDB setup failed: {e}")
@@ -141,6 +181,30 @@ def deploy_lambda():
         logger.error(f"❌ Failed to deploy Lambda: {e}")
         return None
 
+def build_similarity_snapshot():
+    """Write the initial similarity index snapshot so cold containers can load it"""
+    lambda_client = boto3.client(
+        'lambda',
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=REGION
+    )
+    try:
+        response = lambda_client.invoke(
+            FunctionName='instagram-api',
+            Payload=json.dumps({'job': 'build_similarity_index'})
+        )
+        result = json.loads(response['Payload'].read())
+        logger.info(f"✅ Built similarity index snapshot: {result.get('body')}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Similarity snapshot build failed: {e}")
+        return False
+
+# Query string parameters passed through to GET routes
+QUERY_PARAMS = ['user_id', 'tag', 'max_distance', 'limit', 'k']
+
 def setup_api_gateway():
     """Create API Gateway with REST endpoints"""
     apigateway = boto3.client(
@@ -197,6 +261,58 @@ def setup_api_gateway():
         )
         image_id_resource_id = image_id_resource['id']
         
+        # Create /images/{image_id}/similar resource
+        similar_resource = apigateway.create_resource(
+            restApiId=api_id,
+            parentId=image_id_resource_id,
+            pathPart='similar'
+        )
+        similar_resource_id = similar_resource['id']
+        
+        # Create /users/{user_id}/stats and /tags/{tag}/stats resources
+        stats_resource_ids = []
+        collection_resource_ids = {}
+        for collection, param in (('users', '{user_id}'), ('tags', '{tag}')):
+            collection_resource = apigateway.create_resource(
+                restApiId=api_id,
+                parentId=root_resource_id,
+                pathPart=collection
+            )
+            collection_resource_ids[collection] = collection_resource['id']
+            param_resource = apigateway.create_resource(
+                restApiId=api_id,
+                parentId=collection_resource['id'],
+                pathPart=param
+            )
+            stats_resource = apigateway.create_resource(
+                restApiId=api_id,
+                parentId=param_resource['id'],
+                pathPart='stats'
+            )
+            stats_resource_ids.append(stats_resource['id'])
+        
+        # Create /tags/top resource
+        top_tags_resource = apigateway.create_resource(
+            restApiId=api_id,
+            parentId=collection_resource_ids['tags'],
+            pathPart='top'
+        )
+        top_tags_resource_id = top_tags_resource['id']
+        
+        # Create /exports and /exports/{export_id} resources
+        exports_resource = apigateway.create_resource(
+            restApiId=api_id,
+            parentId=root_resource_id,
+            pathPart='exports'
+        )
+        exports_resource_id = exports_resource['id']
+        export_id_resource = apigateway.create_resource(
+            restApiId=api_id,
+            parentId=exports_resource_id,
+            pathPart='{export_id}'
+        )
+        export_id_resource_id = export_id_resource['id']
+        
         # Get Lambda ARN
         func_response = lambda_client.get_function(FunctionName='instagram-api')
         function_arn = func_response['Configuration']['FunctionArn']
@@ -208,8 +324,12 @@ def setup_api_gateway():
             {'resource_id': images_resource_id, 'http_method': 'OPTIONS'},
             {'resource_id': image_id_resource_id, 'http_method': 'GET'},
             {'resource_id': image_id_resource_id, 'http_method': 'DELETE'},
-            {'resource_id': image_id_resource_id, 'http_method': 'OPTIONS'}
-        ]
+            {'resource_id': image_id_resource_id, 'http_method': 'OPTIONS'},
+            {'resource_id': similar_resource_id, 'http_method': 'GET'},
+            {'resource_id': top_tags_resource_id, 'http_method': 'GET'},
+            {'resource_id': exports_resource_id, 'http_method': 'POST'},
+            {'resource_id': export_id_resource_id, 'http_method': 'GET'}
+        ] + [{'resource_id': resource_id, 'http_method': 'GET'} for resource_id in stats_resource_ids]
         
         for method in methods:
             # Create method
@@ -228,8 +348,7 @@ def setup_api_gateway():
                     httpMethod=method['http_method'],
                     authorizationType='NONE',
                     requestParameters={
-                        'method.request.querystring.user_id': False,
-                        'method.request.querystring.tag': False
+                        f'method.request.querystring.{name}': False for name in QUERY_PARAMS
                     }
                 )
             
@@ -244,8 +363,8 @@ def setup_api_gateway():
                 integrationHttpMethod='POST',
                 uri=uri,
                 requestParameters={
-                    'integration.request.querystring.user_id': 'method.request.querystring.user_id',
-                    'integration.request.querystring.tag': 'method.request.querystring.tag'
+                    f'integration.request.querystring.{name}': f'method.request.querystring.{name}'
+                    for name in QUERY_PARAMS
                 } if method['http_method'] == 'GET' else {}
             )
         
@@ -263,7 +382,13 @@ def setup_api_gateway():
                 'upload': f"{base_url}/images",
                 'list': f"{base_url}/images",
                 'view': f"{base_url}/images/{{image_id}}",
-                'delete': f"{base_url}/images/{{image_id}}"
+                'delete': f"{base_url}/images/{{image_id}}",
+                'similar': f"{base_url}/images/{{image_id}}/similar",
+                'user_stats': f"{base_url}/users/{{user_id}}/stats",
+                'tag_stats': f"{base_url}/tags/{{tag}}/stats",
+                'top_tags': f"{base_url}/tags/top",
+                'start_export': f"{base_url}/exports",
+                'export_status': f"{base_url}/exports/{{export_id}}"
             }
         }
         
@@ -297,6 +422,8 @@ def main():
     function_arn = deploy_lambda()
     if not function_arn:
         return False
+    if not build_similarity_snapshot():
+        return False
     
     # Step 5: Setup API Gateway
     print("\n🌐 Setting up API Gateway...")
@@ -314,6 +441,12 @@ def main():
     print(f"  GET    {api_info['endpoints']['list']}           # List images")
     print(f"  GET    {api_info['endpoints']['view']}    # View image")
     print(f"  DELETE {api_info['endpoints']['delete']} # Delete image")
+    print(f"  GET    {api_info['endpoints']['similar']} # Similar images")
+    print(f"  GET    {api_info['endpoints']['user_stats']} # Images per user")
+    print(f"  GET    {api_info['endpoints']['tag_stats']} # Images per tag")
+    print(f"  GET    {api_info['endpoints']['top_tags']}        # Most used tags")
+    print(f"  POST   {api_info['endpoints']['start_export']}          # Start catalog export")
+    print(f"  GET    {api_info['endpoints']['export_status']} # Export progress")
     print("\n🧪 Test Commands (copy-paste ready):")
     print(f"# 1. List images (should be empty)")
     print(f"curl {api_info['endpoints']['list']}")
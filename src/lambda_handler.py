@@ -1,14 +1,486 @@
 """
 Simple Lambda handler - FILTERS WORKING
 """
+import io
 import json
+import os
+import re
+import time
 import uuid
 import boto3
 import base64
-from datetime import datetime
+import random
+import heapq
+import itertools
+import hashlib
+import zlib
+import pstats
+import cProfile
+import tracemalloc
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from decimal import Decimal
+from urllib.parse import unquote
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; perceptual hashes are skipped without it
+    Image = None
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'InstagramImageService')
+
+
+def _env_flag(name):
+    """Return True when an environment variable is set to a truthy value"""
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_number(name, default, cast=int):
+    """Numeric environment setting, falling back to default when unset or malformed"""
+    try:
+        return cast(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class RequestMetrics:
+    """Timing spans and counters collected for a single invocation"""
+
+    def __init__(self, route, request_id=None):
+        self.route = route
+        self.request_id = request_id
+        self.timings = {}
+        self.counts = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000.0
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def incr(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_emf(self, status_code=None):
+        """Build a CloudWatch Embedded Metric Format log record"""
+        metric_defs = [{'Name': name, 'Unit': 'Milliseconds'} for name in self.timings]
+        metric_defs += [{'Name': name, 'Unit': 'Count'} for name in self.counts]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Route']],
+                    'Metrics': metric_defs
+                }]
+            },
+            'Route': self.route,
+            'StatusCode': status_code,
+            'RequestId': self.request_id
+        }
+        for name, value in self.timings.items():
+            record[name] = round(value, 3)
+        record.update(self.counts)
+        return record
+
+    def server_timing(self):
+        """Render timings as a Server-Timing header value"""
+        return ', '.join(f"{name};dur={value:.1f}" for name, value in self.timings.items())
+
+
+class _NullMetrics:
+    """No-op metrics used when instrumentation is turned off"""
+
+    _span = nullcontext()
+
+    def span(self, name):
+        return self._span
+
+    def incr(self, name, value=1):
+        pass
+
+
+_NULL_METRICS = _NullMetrics()
+_current_metrics = contextvars.ContextVar('current_metrics', default=_NULL_METRICS)
+
+
+def current_metrics():
+    """Metrics collector for the invocation in progress"""
+    return _current_metrics.get()
+
+
+AWS_ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL', 'http://localstack:4566') or None
+# Host that clients reach S3 on; presigned URLs are signed for it
+S3_PUBLIC_ENDPOINT_URL = os.environ.get('S3_PUBLIC_ENDPOINT_URL', 'http://localhost:4566') or None
+# Object keys are content-addressed and never rewritten, so they can be cached for good
+IMAGE_CACHE_CONTROL = os.environ.get('IMAGE_CACHE_CONTROL', 'max-age=31536000, immutable')
+
+# Error codes that mean a dependency is saturated rather than the request being wrong
+THROTTLE_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'RequestThrottled',
+    'ServiceUnavailable',
+    'InternalServerError'
+}
+
+_aws_local = threading.local()
+
+
+def _aws_config():
+    return Config(
+        retries={
+            'mode': 'adaptive',
+            'max_attempts': _env_number('AWS_MAX_ATTEMPTS', 4)
+        },
+        connect_timeout=_env_number('AWS_CONNECT_TIMEOUT', 2, float),
+        read_timeout=_env_number('AWS_READ_TIMEOUT', 5, float),
+        max_pool_connections=_env_number('AWS_MAX_POOL_CONNECTIONS', 10)
+    )
+
+
+def _dynamodb_resource():
+    """DynamoDB resource reused across warm invocations (one per thread).
+    
+    Adaptive retry mode rate-limits on the client, so the client must live
+    longer than a single request for it to help.
+    """
+    dynamodb = getattr(_aws_local, 'dynamodb', None)
+    if dynamodb is None:
+        dynamodb = _aws_local.dynamodb = boto3.resource(
+            'dynamodb',
+            endpoint_url=AWS_ENDPOINT_URL,
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name='us-east-1',
+            config=_aws_config()
+        )
+    return dynamodb
+
+
+def _s3_client():
+    """S3 client reused across warm invocations (one per thread)"""
+    s3_client = getattr(_aws_local, 's3', None)
+    if s3_client is None:
+        s3_client = _aws_local.s3 = boto3.client(
+            's3',
+            endpoint_url=AWS_ENDPOINT_URL,
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name='us-east-1',
+            config=_aws_config()
+        )
+    return s3_client
+
+
+def _s3_signing_client():
+    """S3 client used only to presign URLs for S3_PUBLIC_ENDPOINT_URL (one per thread)"""
+    s3_client = getattr(_aws_local, 's3_signing', None)
+    if s3_client is None:
+        s3_client = _aws_local.s3_signing = boto3.client(
+            's3',
+            endpoint_url=S3_PUBLIC_ENDPOINT_URL,
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name='us-east-1',
+            config=Config(signature_version='s3v4')
+        )
+    return s3_client
+
+
+def _lambda_client():
+    """Lambda client for asynchronous self-invocation (one per thread)"""
+    lambda_client = getattr(_aws_local, 'lambda_', None)
+    if lambda_client is None:
+        lambda_client = _aws_local.lambda_ = boto3.client(
+            'lambda',
+            endpoint_url=AWS_ENDPOINT_URL,
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name='us-east-1',
+            config=_aws_config()
+        )
+    return lambda_client
+
+
+def reset_aws_clients():
+    """Forget cached clients and circuit breaker state so the next call starts fresh"""
+    _aws_local.__dict__.clear()
+    with _download_urls_lock:
+        _download_urls.clear()
+    for breaker in _breakers.values():
+        breaker.record_success()
+
+
+class ServiceUnavailable(Exception):
+    """A dependency is throttling us or its circuit breaker is open"""
+
+    def __init__(self, dependency, reason, retry_after):
+        super().__init__(f"{dependency} unavailable: {reason}")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fail fast after repeated throttling until a cool-down has passed.
+    
+    After the cool-down one trial call is let through (half-open); success
+    closes the breaker, another failure re-opens it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def _threshold(self):
+        return _env_number('CIRCUIT_FAILURE_THRESHOLD', 5)
+
+    def _reset_seconds(self):
+        return _env_number('CIRCUIT_RESET_SECONDS', 30, float)
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self._reset_seconds() - time.time()
+            if remaining > 0 or self.trial_in_flight:
+                current_metrics().incr('circuit_rejections')
+                raise ServiceUnavailable(self.name, 'circuit open', max(int(remaining), 1))
+            self.trial_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self._threshold():
+                self.opened_at = time.time()
+
+
+_breakers = {'dynamodb': CircuitBreaker('dynamodb'), 's3': CircuitBreaker('s3')}
+
+
+def aws_call(span_name, fn, *args, **kwargs):
+    """Call a DynamoDB or S3 operation with timing, throttle accounting and circuit breaking.
+    
+    The dependency is taken from the span name prefix (s3_* or ddb_*).
+    Throttling that outlasts botocore's own retries raises ServiceUnavailable.
+    """
+    dependency = 's3' if span_name.startswith('s3_') else 'dynamodb'
+    breaker = _breakers[dependency]
+    breaker.before_call()
+    metrics = current_metrics()
+    try:
+        with metrics.span(span_name):
+            response = fn(*args, **kwargs)
+    except ClientError as e:
+        metrics.incr('aws_retries', e.response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        code = e.response.get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            metrics.incr('aws_throttles')
+            breaker.record_failure()
+            raise ServiceUnavailable(dependency, code, 1) from e
+        # The service answered; the request itself was at fault
+        breaker.record_success()
+        raise
+    except (EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError) as e:
+        breaker.record_failure()
+        raise ServiceUnavailable(dependency, type(e).__name__, 1) from e
+    breaker.record_success()
+    if isinstance(response, dict):
+        retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            metrics.incr('aws_retries', retries)
+    return response
+
+
+def _backoff_delay(attempt):
+    """Full-jitter exponential backoff delay in seconds"""
+    base = _env_number('AWS_BACKOFF_BASE', 0.05, float)
+    cap = _env_number('AWS_BACKOFF_CAP', 2, float)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _service_unavailable(headers, error):
+    return {
+        'statusCode': 503,
+        'headers': dict(headers, **{'Retry-After': str(error.retry_after)}),
+        'body': json.dumps({'error': str(error), 'dependency': error.dependency})
+    }
+
+
+_PATH_PARAMS = {'images': '{image_id}', 'users': '{user_id}', 'tags': '{tag}', 'exports': '{export_id}'}
+_PATH_LITERALS = {'top', 'search'}
+_KNOWN_ROUTES = (
+    '/images',
+    '/images/search',
+    '/images/{image_id}',
+    '/images/{image_id}/similar',
+    '/users/{user_id}/stats',
+    '/tags/{tag}/stats',
+    '/tags/top',
+    '/exports',
+    '/exports/{export_id}'
+)
+
+def _route_label(event):
+    """Low-cardinality route name used as the metrics dimension.
+    
+    Paths that match no known route share one label so probes for random
+    URLs cannot create new metric series.
+    """
+    method = event.get('httpMethod', 'GET')
+    resource = event.get('resource')
+    if resource:
+        return f"{method} {resource}"
+    path = re.sub(
+        r'/(' + '|'.join(_PATH_PARAMS) + r')/([^/]+)',
+        lambda m: m.group(0) if m.group(2) in _PATH_LITERALS
+        else f"/{m.group(1)}/{_PATH_PARAMS[m.group(1)]}",
+        event.get('path', '')
+    )
+    for route in _KNOWN_ROUTES:
+        if path.endswith(route):
+            return f"{method} {route}"
+    return f"{method} unmatched"
+
+
+def _should_profile(event):
+    """Decide whether this invocation is profiled"""
+    if _env_flag('PROFILE_HEADER_ENABLED'):
+        request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        if request_headers.get('x-profile', '').lower() in ('1', 'true'):
+            return True
+    sample_rate = _env_number('PROFILE_SAMPLE_RATE', 0.0, float)
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def _profiled(handler, event, context):
+    """Run handler under cProfile and tracemalloc and store the results"""
+    request_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+    top_n = max(_env_number('PROFILE_TOP_N', 30), 1)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(max(_env_number('PROFILE_TRACEMALLOC_FRAMES', 1), 1))
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        response = handler(event, context)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+    try:
+        _write_profile(request_id, event, response, profiler, snapshot, top_n)
+    except Exception as e:
+        print(json.dumps({'profile_error': str(e), 'request_id': request_id}))
+    return response
+
+
+def _write_profile(request_id, event, response, profiler, snapshot, top_n):
+    """Write the raw cProfile dump and a text summary to /tmp or S3"""
+    report = io.StringIO()
+    report.write(f"request_id: {request_id}\n")
+    report.write(f"route: {_route_label(event)}\n")
+    report.write(f"status: {response.get('statusCode')}\n\n")
+    report.write(f"== cProfile (top {top_n} by cumulative time) ==\n")
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top_n)
+    report.write(f"\n== tracemalloc (top {top_n} allocation sites) ==\n")
+    for stat in snapshot.statistics('lineno')[:top_n]:
+        report.write(f"{stat}\n")
+
+    output = os.environ.get('PROFILE_OUTPUT', '/tmp/profiles')
+
+    if output.startswith('s3://'):
+        raw_path = f"/tmp/{request_id}.prof"
+        profiler.dump_stats(raw_path)
+        bucket, _, prefix = output[len('s3://'):].partition('/')
+        prefix = prefix.rstrip('/')
+        s3_client = _s3_client()
+        with open(raw_path, 'rb') as f:
+            s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{request_id}.prof".lstrip('/'), Body=f.read())
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"{prefix}/{request_id}.txt".lstrip('/'),
+            Body=report.getvalue().encode('utf-8'),
+            ContentType='text/plain'
+        )
+        os.remove(raw_path)
+    else:
+        os.makedirs(output, exist_ok=True)
+        profiler.dump_stats(os.path.join(output, f"{request_id}.prof"))
+        with open(os.path.join(output, f"{request_id}.txt"), 'w') as f:
+            f.write(report.getvalue())
+        _prune_profiles(output, max(_env_number('PROFILE_MAX_FILES', 20), 1))
+
+
+def _prune_profiles(directory, max_profiles):
+    """Keep only the newest max_profiles profiles so /tmp cannot fill up"""
+    dumps = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.endswith('.prof')),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True
+    )
+    for entry in dumps[max_profiles:]:
+        for path in (entry.path, entry.path[:-len('.prof')] + '.txt'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
 
 def lambda_handler(event, context):
     """Main Lambda handler"""
+    if _should_profile(event):
+        return _profiled(_instrumented, event, context)
+    return _instrumented(event, context)
+
+
+def _instrumented(event, context):
+    """Run the request with timing spans when metrics are enabled"""
+    emit_metrics = _env_flag('METRICS_ENABLED')
+    server_timing = _env_flag('SERVER_TIMING_ENABLED')
+    if not (emit_metrics or server_timing):
+        return _route(event)
+
+    metrics = RequestMetrics(_route_label(event), getattr(context, 'aws_request_id', None))
+    token = _current_metrics.set(metrics)
+    try:
+        with metrics.span('total'):
+            response = _route(event)
+    finally:
+        _current_metrics.reset(token)
+
+    if emit_metrics:
+        print(json.dumps(metrics.to_emf(response.get('statusCode'))))
+    if server_timing:
+        response['headers'] = dict(response.get('headers') or {})
+        response['headers']['Server-Timing'] = metrics.server_timing()
+    return response
+
+
+def _route(event):
+    """Dispatch the request to the matching handler"""
     try:
         method = event.get('httpMethod', 'GET')
         path = event.get('path', '')
@@ -18,13 +490,50 @@ def lambda_handler(event, context):
             'Access-Control-Allow-Origin': '*'
         }
         
+        # Scheduled maintenance jobs (EventBridge rules invoke with {"job": ...})
+        if event.get('job') == 'reconcile_stats':
+            dynamodb = _dynamodb_resource()
+            result = reconcile_stats(dynamodb, dry_run=bool(event.get('dry_run')))
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps(result)}
+        if event.get('job') == 'refresh_top_tags':
+            dynamodb = _dynamodb_resource()
+            top = refresh_top_tags(dynamodb)
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'tags_ranked': len(top)})}
+        if event.get('job') == 'build_similarity_index':
+            indexed = build_similarity_index(_dynamodb_resource(), _s3_client())
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'images_indexed': indexed})}
+        
+        if event.get('job') == 'build_search_index':
+            indexed = build_search_index(_dynamodb_resource())
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'images_indexed': indexed})}
+        if event.get('job') == 'export_catalog':
+            return run_export_job(event, headers)
+        
         if method == 'OPTIONS':
             return {'statusCode': 200, 'headers': headers, 'body': ''}
         
+        if method == 'POST' and path.endswith('/exports'):
+            return handle_start_export(event, headers)
+        elif method == 'GET' and '/exports/' in path:
+            return handle_export_status(path.split('/')[-1], headers)
+        
         if method == 'GET' and path.endswith('/images'):
             return handle_list_images(event, headers)
         elif method == 'POST' and path.endswith('/images'):
             return handle_upload_image(event, headers)
+        elif method == 'GET' and path.endswith('/tags/top'):
+            return handle_top_tags(event, headers)
+        elif method == 'GET' and '/users/' in path and path.endswith('/stats'):
+            user_id = unquote(path.split('/')[-2])
+            return handle_stats('user', user_id, headers)
+        elif method == 'GET' and '/tags/' in path and path.endswith('/stats'):
+            tag = unquote(path.split('/')[-2])
+            return handle_stats('tag', tag, headers)
+        elif method == 'GET' and path.endswith('/images/search'):
+            return handle_search_images(event, headers)
+        elif method == 'GET' and '/images/' in path and path.endswith('/similar'):
+            image_id = path.split('/')[-2]
+            return handle_similar_images(image_id, event, headers)
         elif method == 'GET' and '/images/' in path:
             image_id = path.split('/')[-1]
             return handle_get_image(image_id, headers)
@@ -38,6 +547,8 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': 'Not found'})
             }
             
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -45,6 +556,77 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
+def _paginate_responses(operation, span_name, **kwargs):
+    """Yield each response of a paginated scan or query.
+    
+    A throttled page is retried with jittered backoff instead of
+    abandoning the read part-way through.
+    """
+    max_attempts = max(_env_number('AWS_PAGE_ATTEMPTS', 5), 1)
+    while True:
+        for attempt in range(max_attempts):
+            try:
+                response = aws_call(span_name, operation, **kwargs)
+                break
+            except ServiceUnavailable as e:
+                if e.reason == 'circuit open' or attempt == max_attempts - 1:
+                    raise
+                time.sleep(_backoff_delay(attempt))
+        yield response
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _paginate(operation, span_name, **kwargs):
+    """Yield each page of Items from a paginated scan or query"""
+    for response in _paginate_responses(operation, span_name, **kwargs):
+        yield response.get('Items', [])
+
+def _scan_pages(table, span_name='ddb_scan', **kwargs):
+    """Yield each page of Items from a paginated table scan"""
+    return _paginate(table.scan, span_name, **kwargs)
+
+def _query_pages(table, span_name='ddb_query', **kwargs):
+    """Yield each page of Items from a paginated query"""
+    return _paginate(table.query, span_name, **kwargs)
+
+def _batch_get_items(dynamodb, table_name, keys, projection=None):
+    """Fetch items by key with BatchGetItem, 100 keys per request.
+    
+    Unprocessed keys (partial throttling) are retried with jittered backoff.
+    """
+    items = []
+    for start in range(0, len(keys), 100):
+        request = {table_name: {'Keys': keys[start:start + 100]}}
+        if projection:
+            request[table_name]['ProjectionExpression'] = projection
+        attempt = 0
+        while request:
+            response = aws_call('ddb_batch_get_item', dynamodb.batch_get_item, RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request = response.get('UnprocessedKeys') or None
+            if request:
+                current_metrics().incr('ddb_unprocessed_retries')
+                time.sleep(_backoff_delay(attempt))
+                attempt += 1
+    return items
+
+def _batch_write_items(dynamodb, table_name, requests):
+    """Apply PutRequest/DeleteRequest entries with BatchWriteItem, 25 per request.
+    
+    Unprocessed items (partial throttling) are retried with jittered backoff.
+    """
+    for start in range(0, len(requests), 25):
+        request = {table_name: requests[start:start + 25]}
+        attempt = 0
+        while request:
+            response = aws_call('ddb_batch_write_item', dynamodb.batch_write_item, RequestItems=request)
+            request = response.get('UnprocessedItems') or None
+            if request:
+                current_metrics().incr('ddb_unprocessed_retries')
+                time.sleep(_backoff_delay(attempt))
+                attempt += 1
+
 def handle_list_images(event, headers):
     """List images with WORKING filters"""
     try:
@@ -53,19 +635,15 @@ def handle_list_images(event, headers):
         user_filter = query_params.get('user_id')
         tag_filter = query_params.get('tag')
         
-        dynamodb = boto3.resource(
-            'dynamodb',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
-        )
+        dynamodb = _dynamodb_resource()
         table = dynamodb.Table('images')
+        metrics = current_metrics()
         
         # Use GSI for efficient user-based queries
         if user_filter:
             # Query GSI for specific user
-            response = table.query(
+            response = aws_call(
+                'ddb_query', table.query,
                 IndexName='user-upload-date-index',
                 KeyConditionExpression='user_id = :user_id',
                 ExpressionAttributeValues={':user_id': user_filter},
@@ -81,7 +659,8 @@ def handle_list_images(event, headers):
                 
         elif tag_filter:
             # No user filter, but tag filter - need to scan and filter by tag
-            response = table.scan(
+            response = aws_call(
+                'ddb_scan', table.scan,
                 FilterExpression='contains(tags, :tag)',
                 ExpressionAttributeValues={':tag': tag_filter}
             )
@@ -89,21 +668,20 @@ def handle_list_images(event, headers):
             
         else:
             # No filters - get all images (scan)
-            response = table.scan()
+            response = aws_call('ddb_scan', table.scan)
             filtered_items = response.get('Items', [])
         
         # Sort by upload_date descending if not already sorted by GSI
         if not user_filter:
-            filtered_items = sorted(
-                filtered_items, 
-                key=lambda x: x.get('upload_date', ''), 
-                reverse=True
-            )
+            with metrics.span('sort'):
+                filtered_items = sorted(
+                    filtered_items, 
+                    key=lambda x: x.get('upload_date', ''), 
+                    reverse=True
+                )
         
-        return {
-            'statusCode': 200,
-            'headers': headers,
-            'body': json.dumps({
+        with metrics.span('serialize'):
+            body = json.dumps({
                 'images': filtered_items,
                 'count': len(filtered_items),
                 'filters_applied': {
@@ -112,7 +690,14 @@ def handle_list_images(event, headers):
                 },
                 'query_method': 'gsi_query' if user_filter else ('scan_with_filter' if tag_filter else 'full_scan')
             })
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': body
         }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
     except Exception as e:
         return {
             'statusCode': 200,
@@ -125,6 +710,313 @@ def handle_list_images(event, headers):
             })
         }
 
+def store_image_blob(blobs_table, s3_client, image_data, content_type):
+    """Store image bytes under a content-addressed key and take a reference.
+    
+    Returns (s3_key, content_hash, deduplicated). The S3 PUT is skipped
+    only when the blob is already committed, i.e. a previous PUT of the
+    same bytes is known to have succeeded; otherwise this upload PUTs
+    (idempotently) itself, so metadata never points at a missing object.
+    Each incarnation of a blob item gets its own generation in the S3 key,
+    so a late delete of an old generation cannot remove a fresh upload.
+    """
+    metrics = current_metrics()
+    with metrics.span('hash'):
+        content_hash = hashlib.sha256(image_data).hexdigest()
+    generation = uuid.uuid4().hex
+    
+    response = aws_call(
+        'ddb_update_item', blobs_table.update_item,
+        Key={'content_hash': content_hash},
+        UpdateExpression='ADD ref_count :one SET s3_key = if_not_exists(s3_key, :key), '
+                         'content_type = if_not_exists(content_type, :content_type), '
+                         'generation = if_not_exists(generation, :generation)',
+        ExpressionAttributeValues={
+            ':one': 1,
+            ':key': f"images/sha256/{content_hash}/{generation}",
+            ':content_type': content_type,
+            ':generation': generation
+        },
+        ReturnValues='ALL_NEW'
+    )
+    blob = response['Attributes']
+    s3_key = blob['s3_key']
+    deduplicated = blob.get('state') == 'committed'
+    
+    if deduplicated:
+        metrics.incr('dedup_hits')
+    else:
+        try:
+            aws_call(
+                's3_put_object', s3_client.put_object,
+                Bucket='instagram-images',
+                Key=s3_key,
+                Body=image_data,
+                ContentType=content_type,
+                CacheControl=IMAGE_CACHE_CONTROL
+            )
+        except Exception:
+            release_image_blob(blobs_table, s3_client, content_hash)
+            raise
+        aws_call(
+            'ddb_update_item', blobs_table.update_item,
+            Key={'content_hash': content_hash},
+            UpdateExpression='SET #state = :committed',
+            ConditionExpression='attribute_exists(content_hash)',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':committed': 'committed'}
+        )
+    
+    return s3_key, content_hash, deduplicated
+
+def release_image_blob(blobs_table, s3_client, content_hash):
+    """Drop one reference to a stored blob, deleting it with the last reference"""
+    response = aws_call(
+        'ddb_update_item', blobs_table.update_item,
+        Key={'content_hash': content_hash},
+        UpdateExpression='ADD ref_count :minus_one',
+        ConditionExpression='attribute_exists(content_hash)',
+        ExpressionAttributeValues={':minus_one': -1},
+        ReturnValues='ALL_NEW'
+    )
+    blob = response['Attributes']
+    if int(blob['ref_count']) > 0:
+        return
+    
+    # Only remove this generation, and only if nobody re-referenced it meanwhile.
+    # A later upload of the same bytes creates a new generation with its own key.
+    condition_values = {':zero': 0}
+    if 'generation' in blob:
+        condition = 'ref_count <= :zero AND generation = :generation'
+        condition_values[':generation'] = blob['generation']
+    else:
+        condition = 'ref_count <= :zero AND attribute_not_exists(generation)'
+    try:
+        aws_call(
+            'ddb_delete_item', blobs_table.delete_item,
+            Key={'content_hash': content_hash},
+            ConditionExpression=condition,
+            ExpressionAttributeValues=condition_values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        raise
+    
+    aws_call(
+        's3_delete_object', s3_client.delete_object,
+        Bucket='instagram-images', Key=blob['s3_key']
+    )
+
+def _tag_shards():
+    return int(os.environ.get('TAG_SHARDS', '10'))
+
+def _tag_window(timestamp):
+    """Hour bucket used for the recently touched tag sets"""
+    return int(timestamp // 3600)
+
+def update_image_counters(stats_table, user_id, tags, delta):
+    """Atomically adjust image counters and tag frequencies.
+    
+    Each item stays small however many tags exist: the user's count and
+    their tag facets (usertags#{user}) are separate items, and every tag
+    has its own counter split over TAG_SHARDS tagfreq#{tag}#{n} items so
+    popular tags do not become hot keys. Touched tags are also added to an
+    hourly tagrecent set, the candidate list for refresh_top_tags.
+    Failures are logged rather than raised; reconcile_stats repairs drift.
+    """
+    metrics = current_metrics()
+    tags = sorted(set(tags or []))
+    shard = random.randrange(_tag_shards())
+    
+    updates = [(f"user#{user_id}", 'ADD image_count :delta', None, {':delta': delta})]
+    if tags:
+        tag_names = {f"#t{i}": f"tag:{tag}" for i, tag in enumerate(tags)}
+        updates.append((f"usertags#{user_id}", 'ADD ' + ', '.join(f"{name} :delta" for name in tag_names),
+                        tag_names, {':delta': delta}))
+        updates += [(f"tagfreq#{tag}#{shard}", 'ADD image_count :delta', None, {':delta': delta})
+                    for tag in tags]
+        now = time.time()
+        updates.append((f"tagrecent#{_tag_window(now)}#{shard}", 'ADD tags :tags SET expires_at = :expires',
+                        None, {':tags': set(tags), ':expires': int(now) + 7 * 86400}))
+    
+    for stat_key, expression, names, values in updates:
+        kwargs = {
+            'Key': {'stat_key': stat_key},
+            'UpdateExpression': expression,
+            'ExpressionAttributeValues': values
+        }
+        if names:
+            kwargs['ExpressionAttributeNames'] = names
+        try:
+            aws_call('ddb_update_counter', stats_table.update_item, **kwargs)
+        except Exception as e:
+            metrics.incr('counter_errors')
+            print(json.dumps({'counter_error': str(e), 'stat_key': stat_key}))
+
+def _tag_counts(dynamodb, tags):
+    """Sum the tagfreq shards of each tag"""
+    keys = [{'stat_key': f"tagfreq#{tag}#{n}"} for tag in tags for n in range(_tag_shards())]
+    counts = dict.fromkeys(tags, 0)
+    for shard in _batch_get_items(dynamodb, 'image_stats', keys, projection='stat_key, image_count'):
+        tag = shard['stat_key'][len('tagfreq#'):].rsplit('#', 1)[0]
+        counts[tag] += int(shard.get('image_count', 0))
+    return counts
+
+RECONCILE_STATE_KEY = 'reconcile#state'
+
+def _confirmed_drift(stats_table, drift, dry_run):
+    """Return the drift that the previous reconcile run also saw.
+    
+    drift maps "{stat_key}|{attribute}" to [observed, expected]. Entries
+    seen for the first time are saved in reconcile#state for the next
+    run to confirm; an upload or delete racing one run changes the pair
+    and never confirms.
+    """
+    state = aws_call(
+        'ddb_get_item', stats_table.get_item, Key={'stat_key': RECONCILE_STATE_KEY}
+    ).get('Item', {})
+    previous = state.get('drift', {})
+    confirmed = {key: pair for key, pair in drift.items() if previous.get(key) == pair}
+    if not dry_run:
+        aws_call('ddb_put_item', stats_table.put_item, Item={
+            'stat_key': RECONCILE_STATE_KEY,
+            'drift': {key: pair for key, pair in drift.items() if key not in confirmed},
+            'updated_at': datetime.now().isoformat()
+        })
+    return confirmed
+
+def reconcile_stats(dynamodb, dry_run=False):
+    """Recount images per user and tag and repair counters that drifted.
+    
+    Counters are read before images are recounted, so an upload or delete
+    racing the job makes the pair (observed, expected) differ between runs.
+    A correction is only applied once two consecutive runs saw the same
+    pair, and only if the counter still holds the observed value; drift
+    seen once is reported as pending. Sharded tag totals are corrected
+    with an ADD on shard 0. The global top tags are rebuilt from the
+    recount.
+    """
+    stats_table = dynamodb.Table('image_stats')
+    observed = {}
+    observed_freq = {}
+    for page in _scan_pages(stats_table):
+        for item in page:
+            stat_key = item['stat_key']
+            if stat_key.startswith(('user#', 'usertags#')):
+                for attr, value in item.items():
+                    if attr == 'image_count' or attr.startswith('tag:'):
+                        observed[(stat_key, attr)] = int(value)
+            elif stat_key.startswith('tagfreq#'):
+                tag = stat_key[len('tagfreq#'):].rsplit('#', 1)[0]
+                observed_freq[tag] = observed_freq.get(tag, 0) + int(item.get('image_count', 0))
+    
+    expected = {}
+    expected_freq = {}
+    checked = 0
+    for page in _scan_pages(dynamodb.Table('images'), ProjectionExpression='user_id, tags'):
+        for item in page:
+            checked += 1
+            tags = set(item.get('tags') or [])
+            user_count = (f"user#{item['user_id']}", 'image_count')
+            expected[user_count] = expected.get(user_count, 0) + 1
+            for tag in tags:
+                facet = (f"usertags#{item['user_id']}", f"tag:{tag}")
+                expected[facet] = expected.get(facet, 0) + 1
+                expected_freq[tag] = expected_freq.get(tag, 0) + 1
+    
+    drift = {}
+    counters = {}
+    for stat_key, attr in sorted(set(expected) | set(observed)):
+        want = expected.get((stat_key, attr), 0)
+        have = observed.get((stat_key, attr))
+        if have != want and not (have is None and want == 0):
+            drift[f"{stat_key}|{attr}"] = [have, want]
+            counters[f"{stat_key}|{attr}"] = (stat_key, attr)
+    for tag in sorted(set(expected_freq) | set(observed_freq)):
+        have, want = observed_freq.get(tag, 0), expected_freq.get(tag, 0)
+        if have != want:
+            drift[f"tagfreq#{tag}|image_count"] = [have, want]
+            counters[f"tagfreq#{tag}|image_count"] = (f"tagfreq#{tag}", 'image_count')
+    confirmed = _confirmed_drift(stats_table, drift, dry_run)
+    
+    fixed = []
+    pending = []
+    skipped = 0
+    for key, (have, want) in drift.items():
+        stat_key, attr = counters[key]
+        entry = {'stat_key': stat_key, 'attribute': attr, 'observed': have, 'expected': want}
+        if key not in confirmed:
+            pending.append(entry)
+            continue
+        fixed.append(entry)
+        if dry_run:
+            continue
+        if stat_key.startswith('tagfreq#'):
+            # A sharded total cannot be compared-and-set; the two-run check stands in
+            aws_call(
+                'ddb_update_item', stats_table.update_item,
+                Key={'stat_key': f"{stat_key}#0"},
+                UpdateExpression='ADD image_count :drift',
+                ExpressionAttributeValues={':drift': want - have}
+            )
+            continue
+        values = {':want': want}
+        if have is None:
+            condition = 'attribute_not_exists(#a)'
+        else:
+            condition = '#a = :have'
+            values[':have'] = have
+        try:
+            aws_call(
+                'ddb_update_item', stats_table.update_item,
+                Key={'stat_key': stat_key},
+                UpdateExpression='SET #a = :want',
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#a': attr},
+                ExpressionAttributeValues=values
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            skipped += 1
+    
+    if not dry_run:
+        # The recount is exact, so it also resets the incrementally maintained ranking
+        _store_top_tags(dynamodb, expected_freq)
+    
+    return {
+        'images_checked': checked, 'fixed': fixed, 'pending': pending,
+        'skipped': skipped, 'dry_run': dry_run
+    }
+
+def image_content_type(filename):
+    """Content type stored with the S3 object, from the file extension"""
+    file_extension = filename.split('.')[-1] if '.' in filename else 'jpg'
+    return f'image/{file_extension}'
+
+def build_image_item(image_id, user_id, filename, image_data, s3_key, content_hash, upload_date,
+                     tags=None, description=''):
+    """Metadata item for a stored image, as written to the images table"""
+    item = {
+        'image_id': image_id,
+        'user_id': user_id,
+        'filename': filename,
+        's3_key': s3_key,
+        'content_hash': content_hash,
+        'upload_date': upload_date,
+        'tags': tags or [],
+        'description': description
+    }
+    
+    with current_metrics().span('phash'):
+        phash = compute_dhash(image_data)
+    if phash:
+        # upload_day only on hashed items keeps phash-day-index sparse
+        item['phash'] = phash
+        item['upload_day'] = upload_date[:10]
+    return item
+
 def handle_upload_image(event, headers):
     """Upload image"""
     try:
@@ -140,48 +1032,34 @@ def handle_upload_image(event, headers):
         image_id = str(uuid.uuid4())
         upload_date = datetime.now().isoformat()
         
+        metrics = current_metrics()
+        
         # Decode image
-        image_data = base64.b64decode(body['image_data'])
-        file_extension = body['filename'].split('.')[-1] if '.' in body['filename'] else 'jpg'
-        s3_key = f"images/{body['user_id']}/{image_id}.{file_extension}"
+        with metrics.span('decode'):
+            image_data = base64.b64decode(body['image_data'])
         
-        # Upload to S3
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
-        )
+        s3_client = _s3_client()
+        dynamodb = _dynamodb_resource()
+        table = dynamodb.Table('images')
         
-        s3_client.put_object(
-            Bucket='instagram-images',
-            Key=s3_key,
-            Body=image_data,
-            ContentType=f'image/{file_extension}'
+        # Store bytes once per distinct content, then save metadata
+        s3_key, content_hash, deduplicated = store_image_blob(
+            dynamodb.Table('image_blobs'), s3_client, image_data, image_content_type(body['filename'])
         )
         
-        # Save to DynamoDB
-        dynamodb = boto3.resource(
-            'dynamodb',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
+        item = build_image_item(
+            image_id, body['user_id'], body['filename'], image_data, s3_key, content_hash,
+            upload_date, body.get('tags', []), body.get('description', '')
         )
-        table = dynamodb.Table('images')
         
-        item = {
-            'image_id': image_id,
-            'user_id': body['user_id'],
-            'filename': body['filename'],
-            's3_key': s3_key,
-            'upload_date': upload_date,
-            'tags': body.get('tags', []),
-            'description': body.get('description', '')
-        }
+        try:
+            aws_call('ddb_put_item', table.put_item, Item=item)
+        except Exception:
+            release_image_blob(dynamodb.Table('image_blobs'), s3_client, content_hash)
+            raise
         
-        table.put_item(Item=item)
+        update_image_counters(dynamodb.Table('image_stats'), body['user_id'], item['tags'], 1)
+        index_image_text(dynamodb, item)
         
         return {
             'statusCode': 201,
@@ -189,10 +1067,13 @@ def handle_upload_image(event, headers):
             'body': json.dumps({
                 'message': 'Image uploaded successfully',
                 'image_id': image_id,
-                'upload_date': upload_date
+                'upload_date': upload_date,
+                'deduplicated': deduplicated
             })
         }
         
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -200,18 +1081,47 @@ def handle_upload_image(event, headers):
             'body': json.dumps({'error': str(e)})
         }
 
+_download_urls = OrderedDict()
+_download_urls_lock = threading.Lock()
+
+def presigned_download_url(s3_key):
+    """Presigned GET URL for an object, reused until shortly before it expires.
+    
+    Signing is pure CPU but not free, so URLs are kept in a small LRU across
+    warm invocations. Handing out the same URL also lets clients and CDNs
+    that key on the full URL reuse their cached copy.
+    Returns (url, expires_at).
+    """
+    ttl = max(_env_number('DOWNLOAD_URL_TTL_SECONDS', 3600), 60)
+    margin = min(max(_env_number('DOWNLOAD_URL_REFRESH_MARGIN', 300), 0), ttl // 2)
+    now = time.time()
+    with _download_urls_lock:
+        cached = _download_urls.get(s3_key)
+        if cached and cached[1] - margin > now:
+            _download_urls.move_to_end(s3_key)
+            current_metrics().incr('presign_cache_hits')
+            return cached
+    
+    with current_metrics().span('presign'):
+        url = _s3_signing_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': 'instagram-images', 'Key': s3_key},
+            ExpiresIn=ttl
+        )
+    entry = (url, int(now) + ttl)
+    with _download_urls_lock:
+        _download_urls[s3_key] = entry
+        _download_urls.move_to_end(s3_key)
+        while len(_download_urls) > max(_env_number('DOWNLOAD_URL_CACHE_SIZE', 1024), 1):
+            _download_urls.popitem(last=False)
+    return entry
+
 def handle_get_image(image_id, headers):
     """Get image details"""
     try:
-        dynamodb = boto3.resource(
-            'dynamodb',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
-        )
+        dynamodb = _dynamodb_resource()
         table = dynamodb.Table('images')
-        response = table.get_item(Key={'image_id': image_id})
+        response = aws_call('ddb_get_item', table.get_item, Key={'image_id': image_id})
         item = response.get('Item')
         
         if not item:
@@ -221,7 +1131,7 @@ def handle_get_image(image_id, headers):
                 'body': json.dumps({'error': 'Image not found'})
             }
         
-        download_url = f"http://localhost:4566/instagram-images/{item['s3_key']}"
+        download_url, expires_at = presigned_download_url(item['s3_key'])
         
         return {
             'statusCode': 200,
@@ -233,9 +1143,12 @@ def handle_get_image(image_id, headers):
                 'upload_date': item['upload_date'],
                 'tags': item.get('tags', []),
                 'description': item.get('description', ''),
-                'download_url': download_url
+                'download_url': download_url,
+                'download_url_expires_at': expires_at
             })
         }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -247,15 +1160,9 @@ def handle_delete_image(image_id, headers):
     """Delete image"""
     try:
         # Get image info
-        dynamodb = boto3.resource(
-            'dynamodb',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
-        )
+        dynamodb = _dynamodb_resource()
         table = dynamodb.Table('images')
-        response = table.get_item(Key={'image_id': image_id})
+        response = aws_call('ddb_get_item', table.get_item, Key={'image_id': image_id})
         item = response.get('Item')
         
         if not item:
@@ -265,18 +1172,33 @@ def handle_delete_image(image_id, headers):
                 'body': json.dumps({'error': 'Image not found'})
             }
         
-        # Delete from S3
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='http://localstack:4566',
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            region_name='us-east-1'
-        )
-        s3_client.delete_object(Bucket='instagram-images', Key=item['s3_key'])
+        s3_client = _s3_client()
+        
+        if item.get('content_hash'):
+            # Shared object: drop the metadata, then release our reference
+            deleted = aws_call(
+                'ddb_delete_item', table.delete_item,
+                Key={'image_id': image_id}, ReturnValues='ALL_OLD'
+            )
+            if deleted.get('Attributes'):
+                release_image_blob(dynamodb.Table('image_blobs'), s3_client, item['content_hash'])
+        else:
+            # Legacy per-upload object
+            aws_call(
+                's3_delete_object', s3_client.delete_object,
+                Bucket='instagram-images', Key=item['s3_key']
+            )
+            
+            deleted = aws_call(
+                'ddb_delete_item', table.delete_item,
+                Key={'image_id': image_id}, ReturnValues='ALL_OLD'
+            )
         
-        # Delete from DynamoDB
-        table.delete_item(Key={'image_id': image_id})
+        # Only the request that actually removed the item adjusts counters
+        if deleted.get('Attributes'):
+            _similarity_index.discard(image_id)
+            update_image_counters(dynamodb.Table('image_stats'), item['user_id'], item.get('tags'), -1)
+            unindex_image_text(dynamodb, deleted['Attributes'])
         
         return {
             'statusCode': 200,
@@ -286,9 +1208,834 @@ def handle_delete_image(image_id, headers):
                 'image_id': image_id
             })
         }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def compute_dhash(image_data, hash_size=8):
+    """Difference hash of an image as a hex string, or None if it cannot be decoded"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            # Let JPEG decode at reduced scale; we only need a tiny thumbnail
+            img.draft('L', (hash_size * 4, hash_size * 4))
+            pixels = img.convert('L').resize((hash_size + 1, hash_size)).tobytes()
+    except Exception:
+        return None
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+def _hamming(a, b):
+    return bin(a ^ b).count('1')
+
+MAX_SIMILARITY_DISTANCE = 15
+_MIH_BANDS = 4
+_MIH_BAND_BITS = 16
+_flip_masks_cache = {}
+
+def _flip_masks(radius):
+    """Every band-width bit mask with at most radius bits set"""
+    if radius not in _flip_masks_cache:
+        _flip_masks_cache[radius] = [
+            sum(1 << bit for bit in bits)
+            for r in range(radius + 1)
+            for bits in itertools.combinations(range(_MIH_BAND_BITS), r)
+        ]
+    return _flip_masks_cache[radius]
+
+class MultiIndexHash:
+    """Multi-index hashing over 64-bit hashes for Hamming-distance range queries.
+    
+    Each hash is split into four 16-bit bands, each with its own lookup
+    table. Two hashes within distance r differ by at most r // 4 bits in
+    some band, so a query probes only those buckets (697 per band at the
+    maximum distance of 15) and verifies each candidate's full distance.
+    """
+
+    def __init__(self):
+        self.tables = [{} for _ in range(_MIH_BANDS)]
+        self.values = {}
+
+    @staticmethod
+    def _bands(value):
+        mask = (1 << _MIH_BAND_BITS) - 1
+        return [(value >> (band * _MIH_BAND_BITS)) & mask for band in range(_MIH_BANDS)]
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value, key):
+        if key in self.values:
+            return
+        self.values[key] = value
+        for band, table in zip(self._bands(value), self.tables):
+            table.setdefault(band, set()).add(key)
+
+    def remove(self, key):
+        value = self.values.pop(key, None)
+        if value is None:
+            return
+        for band, table in zip(self._bands(value), self.tables):
+            bucket = table[band]
+            bucket.discard(key)
+            if not bucket:
+                del table[band]
+
+    def search(self, value, max_distance):
+        """Return (distance, key) pairs within max_distance of value"""
+        if max_distance > MAX_SIMILARITY_DISTANCE:
+            raise ValueError(f"max_distance above {MAX_SIMILARITY_DISTANCE} is not supported")
+        masks = _flip_masks(max_distance // _MIH_BANDS)
+        seen = set()
+        results = []
+        for band, table in zip(self._bands(value), self.tables):
+            for mask in masks:
+                for key in table.get(band ^ mask, ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    distance = _hamming(value, self.values[key])
+                    if distance <= max_distance:
+                        results.append((distance, key))
+        return results
+
+SIMILARITY_SNAPSHOT_KEY = 'indexes/similarity.json'
+# Uploads stamp upload_date before their put lands; re-read this much on each refresh
+_SIMILARITY_OVERLAP = timedelta(minutes=5)
+
+class SimilarityIndex:
+    """In-memory perceptual hash index kept warm across invocations.
+    
+    A cold container loads the snapshot written by the build_similarity_index
+    job, then tops it up from the sparse phash-day-index GSI one upload day
+    at a time. Images deleted through this container are removed at once;
+    others drop out when their metadata lookup comes back empty.
+    """
+
+    def __init__(self):
+        self.index = MultiIndexHash()
+        self.loaded = False
+        self.synced_through = ''
+        self.last_refresh = 0.0
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, image_id, phash):
+        self.index.add(int(phash, 16), image_id)
+
+    def discard(self, image_id):
+        self.index.remove(image_id)
+
+    def load_snapshot(self, s3_client):
+        try:
+            response = aws_call(
+                's3_get_object', s3_client.get_object,
+                Bucket='instagram-images', Key=SIMILARITY_SNAPSHOT_KEY
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                raise ServiceUnavailable('similarity_index', 'snapshot not built', 60) from e
+            raise
+        snapshot = json.loads(response['Body'].read())
+        for image_id, phash in snapshot['hashes'].items():
+            self.add(image_id, phash)
+        self.synced_through = snapshot['synced_through']
+        self.loaded = True
+
+    def refresh(self, table, max_age=None):
+        if max_age is None:
+            max_age = float(os.environ.get('SIMILARITY_REFRESH_SECONDS', '60'))
+        if self.last_refresh and time.time() - self.last_refresh < max_age:
+            return
+        started = datetime.now()
+        day = datetime.fromisoformat(self.synced_through[:10]).date()
+        while day <= started.date():
+            for page in _query_pages(
+                table, 'ddb_query_similarity',
+                IndexName='phash-day-index',
+                KeyConditionExpression='upload_day = :day AND upload_date >= :since',
+                ExpressionAttributeValues={':day': day.isoformat(), ':since': self.synced_through}
+            ):
+                for item in page:
+                    self.add(item['image_id'], item['phash'])
+            day += timedelta(days=1)
+        self.synced_through = (started - _SIMILARITY_OVERLAP).isoformat()
+        self.last_refresh = time.time()
+
+    def search(self, phash, max_distance):
+        return sorted(self.index.search(int(phash, 16), max_distance))
+
+_similarity_index = SimilarityIndex()
+
+def build_similarity_index(dynamodb, s3_client):
+    """Scan every hashed image and write the cold-start snapshot to S3"""
+    started = datetime.now()
+    hashes = {}
+    for page in _scan_pages(
+        dynamodb.Table('images'), 'ddb_scan_similarity',
+        ProjectionExpression='image_id, phash',
+        FilterExpression='attribute_exists(phash)'
+    ):
+        for item in page:
+            hashes[item['image_id']] = item['phash']
+    snapshot = {
+        'synced_through': (started - _SIMILARITY_OVERLAP).isoformat(),
+        'hashes': hashes
+    }
+    aws_call(
+        's3_put_object', s3_client.put_object,
+        Bucket='instagram-images', Key=SIMILARITY_SNAPSHOT_KEY,
+        Body=json.dumps(snapshot), ContentType='application/json'
+    )
+    return len(hashes)
+
+def handle_similar_images(image_id, event, headers):
+    """Find images whose perceptual hash is within max_distance bits"""
+    try:
+        query_params = event.get('queryStringParameters') or {}
+        try:
+            max_distance = int(query_params.get('max_distance', 10))
+            limit = int(query_params.get('limit', 50))
+        except ValueError:
+            max_distance = limit = -1
+        if not 0 <= max_distance <= MAX_SIMILARITY_DISTANCE or not 1 <= limit <= 500:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': f'max_distance must be 0-{MAX_SIMILARITY_DISTANCE} and limit 1-500'
+                })
+            }
+        
+        dynamodb = _dynamodb_resource()
+        table = dynamodb.Table('images')
+        response = aws_call('ddb_get_item', table.get_item, Key={'image_id': image_id})
+        item = response.get('Item')
+        
+        if not item:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({'error': 'Image not found'})
+            }
+        if not item.get('phash'):
+            return {
+                'statusCode': 422,
+                'headers': headers,
+                'body': json.dumps({'error': 'Image has no perceptual hash'})
+            }
+        
+        if not _similarity_index.loaded:
+            _similarity_index.load_snapshot(_s3_client())
+        _similarity_index.refresh(table)
+        _similarity_index.add(image_id, item['phash'])
+        with current_metrics().span('similarity_search'):
+            candidates = [m for m in _similarity_index.search(item['phash'], max_distance)
+                          if m[1] != image_id][:limit]
+        
+        # Look up metadata; anything deleted elsewhere simply drops out
+        found = _batch_get_items(
+            dynamodb, 'images', [{'image_id': m[1]} for m in candidates],
+            projection='image_id, user_id, filename, upload_date'
+        )
+        by_id = {found_item['image_id']: found_item for found_item in found}
+        for candidate_id in set(m[1] for m in candidates) - set(by_id):
+            _similarity_index.discard(candidate_id)
+        matches = [dict(by_id[m[1]], distance=m[0]) for m in candidates if m[1] in by_id]
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'image_id': image_id,
+                'max_distance': max_distance,
+                'matches': matches,
+                'count': len(matches),
+                'index_size': len(_similarity_index)
+            })
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
+
+_SEARCH_TOKEN_RE = re.compile(r'[^\W_]+')
+_SEARCH_STOPWORDS = frozenset(
+    'a an and are as at be by for from in is it of on or the this to with jpg jpeg png gif webp'.split()
+)
+MAX_SEARCH_TERMS = 8
+
+def search_tokens(text):
+    """Lower-cased word tokens of text, without stopwords and one-letter words"""
+    tokens = []
+    for token in _SEARCH_TOKEN_RE.findall((text or '').lower()):
+        token = token[:64]
+        if len(token) > 1 and token not in _SEARCH_STOPWORDS and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+def _image_search_postings(item):
+    """(term, posting) keys indexing an image's description and filename"""
+    tokens = search_tokens(f"{item.get('filename', '')} {item.get('description', '')}")
+    posting = f"{item['upload_date']}#{item['image_id']}"
+    return [{'term': token, 'posting': posting} for token in tokens[:_env_number('SEARCH_MAX_TOKENS', 100)]]
+
+def index_image_text(dynamodb, item):
+    """Add an image to the image_search inverted index.
+    
+    Each token gets one item keyed (term, "{upload_date}#{image_id}"), so a
+    term's posting list is a single newest-first query. Failures are logged
+    rather than raised, like counter updates.
+    """
+    try:
+        _batch_write_items(dynamodb, 'image_search', [
+            {'PutRequest': {'Item': dict(key, image_id=item['image_id'])}}
+            for key in _image_search_postings(item)
+        ])
+    except Exception as e:
+        current_metrics().incr('search_index_errors')
+        print(json.dumps({'search_index_error': str(e), 'image_id': item['image_id']}))
+
+def unindex_image_text(dynamodb, item):
+    """Remove a deleted image's postings from the inverted index"""
+    try:
+        _batch_write_items(dynamodb, 'image_search', [
+            {'DeleteRequest': {'Key': key}} for key in _image_search_postings(item)
+        ])
+    except Exception as e:
+        current_metrics().incr('search_index_errors')
+        print(json.dumps({'search_index_error': str(e), 'image_id': item['image_id']}))
+
+class _PostingCursor:
+    """Newest-first cursor over one term's posting list that can seek backwards in time"""
+
+    def __init__(self, table, term, before=None):
+        self.table = table
+        self.term = term
+        self.buffer = deque()
+        self.exhausted = False
+        self._fill(before, inclusive=False)
+
+    def _fill(self, bound, inclusive):
+        kwargs = {
+            'KeyConditionExpression': '#term = :term',
+            'ExpressionAttributeNames': {'#term': 'term'},
+            'ExpressionAttributeValues': {':term': self.term},
+            'ProjectionExpression': 'posting',
+            'ScanIndexForward': False,
+            'Limit': _env_number('SEARCH_PAGE_SIZE', 100)
+        }
+        if bound is not None:
+            kwargs['KeyConditionExpression'] += ' AND posting ' + ('<=' if inclusive else '<') + ' :bound'
+            kwargs['ExpressionAttributeValues'][':bound'] = bound
+        response = aws_call('ddb_query_search', self.table.query, **kwargs)
+        self.buffer.extend(item['posting'] for item in response.get('Items', []))
+        self.exhausted = 'LastEvaluatedKey' not in response
+
+    def head(self):
+        return self.buffer[0] if self.buffer else None
+
+    def advance(self):
+        last = self.buffer.popleft()
+        if not self.buffer and not self.exhausted:
+            self._fill(last, inclusive=False)
+
+    def seek(self, target):
+        """Skip to the newest posting at or before target"""
+        while self.buffer and self.buffer[0] > target:
+            self.buffer.popleft()
+        if not self.buffer and not self.exhausted:
+            self._fill(target, inclusive=True)
+
+def search_image_postings(dynamodb, terms, limit, before=None):
+    """Postings present in every term's list, newest first, older than before.
+    
+    A leapfrog intersection: each list seeks straight to the oldest head
+    among them, so a rare term steers the search past long runs of a
+    common one with one query per jump. Returns (postings, more).
+    """
+    table = dynamodb.Table('image_search')
+    cursors = [_PostingCursor(table, term, before) for term in terms]
+    postings = []
+    while len(postings) < limit:
+        heads = [cursor.head() for cursor in cursors]
+        if None in heads:
+            return postings, False
+        target = min(heads)
+        if all(head == target for head in heads):
+            postings.append(target)
+            for cursor in cursors:
+                cursor.advance()
+        else:
+            for cursor in cursors:
+                cursor.seek(target)
+    return postings, all(cursor.head() is not None for cursor in cursors)
+
+def handle_search_images(event, headers):
+    """Images whose filename or description contain every query term"""
+    try:
+        query_params = event.get('queryStringParameters') or {}
+        terms = search_tokens(query_params.get('q'))
+        try:
+            limit = int(query_params.get('limit', 20))
+            before = base64.urlsafe_b64decode(query_params['cursor']).decode() if query_params.get('cursor') else None
+        except (ValueError, UnicodeDecodeError):
+            limit = 0
+        if not terms or len(terms) > MAX_SEARCH_TERMS or not 1 <= limit <= 100:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({
+                    'error': f'q needs 1-{MAX_SEARCH_TERMS} searchable words, limit 1-100 and a valid cursor'
+                })
+            }
+        
+        dynamodb = _dynamodb_resource()
+        with current_metrics().span('search_intersect'):
+            postings, more = search_image_postings(dynamodb, terms, limit, before)
+        
+        image_ids = [posting.rsplit('#', 1)[1] for posting in postings]
+        found = _batch_get_items(
+            dynamodb, 'images', [{'image_id': image_id} for image_id in image_ids],
+            projection='image_id, user_id, filename, upload_date, tags, description'
+        )
+        by_id = {item['image_id']: item for item in found}
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'images': [by_id[image_id] for image_id in image_ids if image_id in by_id],
+                'terms': terms,
+                'next_cursor': base64.urlsafe_b64encode(postings[-1].encode()).decode() if more else None
+            }, default=_json_default)
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def build_search_index(dynamodb):
+    """Index every image; for items written before the search index existed"""
+    indexed = 0
+    for page in _scan_pages(
+        dynamodb.Table('images'), 'ddb_scan_search',
+        ProjectionExpression='image_id, upload_date, filename, description'
+    ):
+        for item in page:
+            index_image_text(dynamodb, item)
+            indexed += 1
+    return indexed
+
+def handle_stats(kind, name, headers):
+    """Read a maintained image counter for a user or tag"""
+    try:
+        dynamodb = _dynamodb_resource()
+        if kind == 'tag':
+            image_count = _tag_counts(dynamodb, [name])[name]
+        else:
+            response = aws_call(
+                'ddb_get_item', dynamodb.Table('image_stats').get_item,
+                Key={'stat_key': f"user#{name}"},
+                ProjectionExpression='image_count'
+            )
+            image_count = int((response.get('Item') or {}).get('image_count', 0))
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'user_id' if kind == 'user' else 'tag': name,
+                'image_count': max(image_count, 0)
+            })
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
+
+_top_tags_cache = {'tags': None, 'refreshed_at': 0, 'loaded_at': 0.0}
+
+def _store_top_tags(dynamodb, counts):
+    """Rank tag counts and store them as the precomputed top list"""
+    limit = int(os.environ.get('TOP_TAGS_LIMIT', '1000'))
+    top = heapq.nlargest(limit, ((count, tag) for tag, count in counts.items() if count > 0))
+    refreshed_at = int(time.time())
+    aws_call('ddb_put_item', dynamodb.Table('image_stats').put_item, Item={
+        'stat_key': 'top_tags#global',
+        'tags': [[tag, count] for count, tag in top],
+        'refreshed_at': refreshed_at
+    })
+    _top_tags_cache.update(tags=[[tag, count] for count, tag in top],
+                           refreshed_at=refreshed_at, loaded_at=time.time())
+    return _top_tags_cache['tags']
+
+def refresh_top_tags(dynamodb, stored=None):
+    """Re-rank the stored top list with the tags touched since it was built.
+    
+    Only tags in the tagrecent sets for the hours since the last refresh
+    are re-counted; every other tag still has the count already stored.
+    Cost depends on recent write activity, never on the number of images
+    or distinct tags.
+    """
+    if stored is None:
+        stored = aws_call(
+            'ddb_get_item', dynamodb.Table('image_stats').get_item,
+            Key={'stat_key': 'top_tags#global'}
+        ).get('Item') or {}
+    counts = {tag: int(count) for tag, count in stored.get('tags', [])}
+    
+    now = time.time()
+    # Re-read the hour of the last refresh too; it may have gained tags since
+    first_window = max(_tag_window(int(stored.get('refreshed_at', now))), _tag_window(now) - 48)
+    keys = [{'stat_key': f"tagrecent#{window}#{n}"}
+            for window in range(first_window, _tag_window(now) + 1) for n in range(_tag_shards())]
+    touched = set()
+    for recent in _batch_get_items(dynamodb, 'image_stats', keys, projection='tags'):
+        touched.update(recent.get('tags', ()))
+    
+    counts.update(_tag_counts(dynamodb, sorted(touched)))
+    return _store_top_tags(dynamodb, counts)
+
+def _global_top_tags(dynamodb):
+    """Precomputed global top tags, refreshed when older than TOP_TAGS_REFRESH_SECONDS"""
+    cache_seconds = float(os.environ.get('TOP_TAGS_CACHE_SECONDS', '60'))
+    if _top_tags_cache['tags'] is not None and time.time() - _top_tags_cache['loaded_at'] < cache_seconds:
+        return _top_tags_cache['tags'], _top_tags_cache['refreshed_at']
+    
+    item = aws_call(
+        'ddb_get_item', dynamodb.Table('image_stats').get_item,
+        Key={'stat_key': 'top_tags#global'}
+    ).get('Item')
+    refresh_seconds = int(os.environ.get('TOP_TAGS_REFRESH_SECONDS', '300'))
+    if not item or time.time() - int(item['refreshed_at']) > refresh_seconds:
+        refresh_top_tags(dynamodb, item or {})
+    else:
+        _top_tags_cache.update(tags=[[tag, int(count)] for tag, count in item['tags']],
+                               refreshed_at=int(item['refreshed_at']), loaded_at=time.time())
+    return _top_tags_cache['tags'], _top_tags_cache['refreshed_at']
+
+def handle_top_tags(event, headers):
+    """Most used tags overall or for one user"""
+    try:
+        query_params = event.get('queryStringParameters') or {}
+        user_id = query_params.get('user_id')
+        max_k = int(os.environ.get('TOP_TAGS_LIMIT', '1000'))
+        try:
+            k = int(query_params.get('k', 50))
+        except ValueError:
+            k = 0
+        if not 1 <= k <= max_k:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({'error': f'k must be between 1 and {max_k}'})
+            }
+        
+        dynamodb = _dynamodb_resource()
+        
+        if user_id:
+            item = aws_call(
+                'ddb_get_item', dynamodb.Table('image_stats').get_item,
+                Key={'stat_key': f"usertags#{user_id}"}
+            ).get('Item') or {}
+            counts = ((int(value), attr[len('tag:'):]) for attr, value in item.items()
+                      if attr.startswith('tag:') and int(value) > 0)
+            top = [[tag, count] for count, tag in heapq.nlargest(k, counts)]
+            refreshed_at = int(time.time())
+        else:
+            top, refreshed_at = _global_top_tags(dynamodb)
+            top = top[:k]
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({
+                'tags': [{'tag': tag, 'count': count} for tag, count in top],
+                'k': k,
+                'user_id': user_id,
+                'refreshed_at': refreshed_at
+            })
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': headers,
             'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        }
+
+def _json_default(value):
+    """JSON encoding for the DynamoDB types json.dumps does not know"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+EXPORT_BUCKET = 'instagram-images'
+_MIN_PART_BYTES = 5 * 1024 * 1024  # S3 minimum for every part but the last
+
+def _read_json_object(s3_client, key):
+    """Decode a small JSON object from the bucket, or None if it does not exist"""
+    try:
+        response = aws_call('s3_get_object', s3_client.get_object, Bucket=EXPORT_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+def _write_json_object(s3_client, key, value):
+    aws_call(
+        's3_put_object', s3_client.put_object,
+        Bucket=EXPORT_BUCKET, Key=key, Body=json.dumps(value, default=_json_default),
+        ContentType='application/json'
+    )
+
+class _ExportPart:
+    """NDJSON lines for one multipart-upload part, optionally as one gzip member.
+    
+    Gzip members concatenate into a valid gzip file, so each part can be
+    compressed on its own and the completed object still decompresses
+    as a single stream.
+    """
+
+    def __init__(self, compress):
+        self.buffer = io.BytesIO()
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.items = 0
+
+    def write(self, item):
+        line = json.dumps(item, default=_json_default, separators=(',', ':')).encode() + b'\n'
+        self.buffer.write(self.compressor.compress(line) if self.compressor else line)
+        self.items += 1
+
+    def size(self):
+        return self.buffer.tell()
+
+    def finish(self):
+        if self.compressor:
+            self.buffer.write(self.compressor.flush())
+        return self.buffer.getvalue()
+
+def start_export(s3_client, total_segments=1, compress=True):
+    """Create an export and return its manifest"""
+    manifest = {
+        'export_id': uuid.uuid4().hex,
+        'total_segments': total_segments,
+        'compress': compress,
+        'created_at': datetime.now().isoformat()
+    }
+    _write_json_object(s3_client, f"exports/{manifest['export_id']}/manifest.json", manifest)
+    return manifest
+
+def export_catalog(dynamodb, s3_client, export_id, segment=0, total_segments=1, compress=True, deadline=None):
+    """Stream one parallel-scan segment of the images table to S3 as NDJSON.
+    
+    Items go out through a multipart upload, a part at a time, so memory
+    stays at about one part plus one scan page whatever the table size.
+    After each part the scan position, upload id and part ETags are
+    checkpointed to S3, and a rerun with the same export_id resumes from
+    there. Returns the checkpoint; its status stays 'running' when the
+    deadline (a time.time() value) stopped the export early.
+    """
+    prefix = f"exports/{export_id}"
+    checkpoint_key = f"{prefix}/checkpoints/{segment:04d}.json"
+    state = _read_json_object(s3_client, checkpoint_key)
+    if state is None:
+        key = f"{prefix}/part-{segment:04d}.ndjson" + ('.gz' if compress else '')
+        upload = aws_call(
+            's3_create_multipart_upload', s3_client.create_multipart_upload,
+            Bucket=EXPORT_BUCKET, Key=key,
+            ContentType='application/gzip' if compress else 'application/x-ndjson'
+        )
+        state = {
+            'key': key, 'upload_id': upload['UploadId'], 'compress': compress,
+            'parts': [], 'start_key': None, 'items': 0, 'status': 'running'
+        }
+        _write_json_object(s3_client, checkpoint_key, state)
+    
+    if state['status'] == 'running':
+        part_bytes = max(_env_number('EXPORT_PART_BYTES', 8 * 1024 * 1024), _MIN_PART_BYTES)
+        scan_kwargs = {'Segment': segment, 'TotalSegments': total_segments} if total_segments > 1 else {}
+        if state['start_key']:
+            scan_kwargs['ExclusiveStartKey'] = state['start_key']
+        part = _ExportPart(state['compress'])
+        
+        def upload_part(body, items, start_key):
+            part_number = len(state['parts']) + 1
+            response = aws_call(
+                's3_upload_part', s3_client.upload_part,
+                Bucket=EXPORT_BUCKET, Key=state['key'], UploadId=state['upload_id'],
+                PartNumber=part_number, Body=body
+            )
+            state['parts'].append({'PartNumber': part_number, 'ETag': response['ETag']})
+            state['items'] += items
+            state['start_key'] = start_key
+            _write_json_object(s3_client, checkpoint_key, state)
+        
+        for response in _paginate_responses(dynamodb.Table('images').scan, 'ddb_scan_export', **scan_kwargs):
+            for item in response.get('Items', []):
+                part.write(item)
+            # Parts end on page boundaries so the checkpoint is a resumable scan position
+            if 'LastEvaluatedKey' in response and part.size() >= part_bytes:
+                upload_part(part.finish(), part.items, response['LastEvaluatedKey'])
+                part = _ExportPart(state['compress'])
+                if deadline is not None and time.time() > deadline:
+                    return state
+        
+        if part.items or not state['parts']:
+            upload_part(part.finish(), part.items, None)
+        state['status'] = 'completing'
+        _write_json_object(s3_client, checkpoint_key, state)
+    
+    if state['status'] == 'completing':
+        try:
+            aws_call(
+                's3_complete_multipart_upload', s3_client.complete_multipart_upload,
+                Bucket=EXPORT_BUCKET, Key=state['key'], UploadId=state['upload_id'],
+                MultipartUpload={'Parts': state['parts']}
+            )
+        except ClientError as e:
+            # Completed by an earlier attempt that died before its checkpoint
+            if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                raise
+        state['status'] = 'complete'
+        state['completed_at'] = datetime.now().isoformat()
+        _write_json_object(s3_client, checkpoint_key, state)
+    return state
+
+def export_status(s3_client, export_id):
+    """Manifest plus per-segment progress, or None for an unknown export"""
+    manifest = _read_json_object(s3_client, f"exports/{export_id}/manifest.json")
+    if manifest is None:
+        return None
+    segments = []
+    for segment in range(manifest['total_segments']):
+        state = _read_json_object(s3_client, f"exports/{export_id}/checkpoints/{segment:04d}.json") or {}
+        segments.append({
+            'segment': segment,
+            'status': state.get('status', 'pending'),
+            'items': state.get('items', 0),
+            'key': state.get('key')
+        })
+    statuses = set(entry['status'] for entry in segments)
+    return dict(
+        manifest,
+        status='complete' if statuses == {'complete'} else 'running',
+        items=sum(entry['items'] for entry in segments),
+        segments=segments
+    )
+
+def _invoke_export_job(export_id, segment, total_segments, compress):
+    """Run one export segment in the background via an asynchronous self-invocation"""
+    with current_metrics().span('lambda_invoke'):
+        _lambda_client().invoke(
+            FunctionName=os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'instagram-api'),
+            InvocationType='Event',
+            Payload=json.dumps({
+                'job': 'export_catalog', 'export_id': export_id, 'segment': segment,
+                'total_segments': total_segments, 'compress': compress
+            })
+        )
+
+def run_export_job(event, headers):
+    """Export one segment until the time budget runs out, then hand off to a fresh invocation"""
+    budget = _env_number('EXPORT_TIME_BUDGET_SECONDS', 20, float)
+    state = export_catalog(
+        _dynamodb_resource(), _s3_client(), event['export_id'],
+        segment=int(event.get('segment', 0)), total_segments=int(event.get('total_segments', 1)),
+        compress=event.get('compress', True), deadline=time.time() + budget
+    )
+    if state['status'] != 'complete':
+        _invoke_export_job(event['export_id'], int(event.get('segment', 0)),
+                           int(event.get('total_segments', 1)), event.get('compress', True))
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps({'status': state['status'], 'items': state['items'], 'parts': len(state['parts'])})
+    }
+
+def handle_start_export(event, headers):
+    """Start an asynchronous NDJSON export of the catalog"""
+    try:
+        body = json.loads(event.get('body') or '{}')
+        segments = body.get('segments', 1)
+        if not isinstance(segments, int) or not 1 <= segments <= 64:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({'error': 'segments must be an integer between 1 and 64'})
+            }
+        compress = bool(body.get('compress', True))
+        
+        manifest = start_export(_s3_client(), segments, compress)
+        for segment in range(segments):
+            _invoke_export_job(manifest['export_id'], segment, segments, compress)
+        
+        return {
+            'statusCode': 202,
+            'headers': headers,
+            'body': json.dumps(dict(manifest, status='running'))
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def handle_export_status(export_id, headers):
+    """Progress of an export, with download URLs once it has finished"""
+    try:
+        status = export_status(_s3_client(), export_id)
+        if status is None:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({'error': 'Export not found'})
+            }
+        if status['status'] == 'complete':
+            status['download_urls'] = [presigned_download_url(entry['key'])[0] for entry in status['segments']]
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps(status)
+        }
+    except ServiceUnavailable as e:
+        return _service_unavailable(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)})
+        }
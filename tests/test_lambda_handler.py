@@ -1,12 +1,20 @@
 """
 Unit tests for Instagram Image Service Lambda handler
 """
+import io
+import gzip
 import json
 import pytest
 import boto3
 import os
+from datetime import datetime
+from decimal import Decimal
 from unittest.mock import patch, MagicMock
-from src.lambda_handler import lambda_handler
+from botocore.exceptions import ClientError
+from src.lambda_handler import (
+    lambda_handler, reconcile_stats, reset_aws_clients, _batch_get_items, export_catalog,
+    CircuitBreaker, MultiIndexHash, ServiceUnavailable, SimilarityIndex, compute_dhash
+)
 
 # Mock AWS credentials
 os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
@@ -14,6 +22,13 @@ os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
 os.environ['AWS_SECURITY_TOKEN'] = 'testing'
 os.environ['AWS_SESSION_TOKEN'] = 'testing'
 
+@pytest.fixture(autouse=True)
+def fresh_aws_clients():
+    """Clients are cached across invocations; give each test its own mocks"""
+    reset_aws_clients()
+    yield
+    reset_aws_clients()
+
 class TestLambdaHandler:
     
     @patch('boto3.resource')
@@ -264,6 +279,38 @@ class TestLambdaHandler:
         assert body['user_id'] == 'test-user'
         assert 'download_url' in body
     
+    @patch('src.lambda_handler.time.time')
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_get_image_reuses_presigned_url(self, mock_resource, mock_client, mock_time):
+        """Test download URLs are presigned once and reused until close to expiry"""
+        mock_time.return_value = 1000.0
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {
+            'image_id': 'test-image', 'user_id': 'u', 'filename': 't.jpg',
+            's3_key': 'images/sha256/abc/g1', 'upload_date': '2024-01-01T00:00:00'
+        }}
+        mock_resource.return_value.Table.return_value = mock_table
+        signer = mock_client.return_value
+        signer.generate_presigned_url.side_effect = ['https://signed/1', 'https://signed/2']
+        event = {'httpMethod': 'GET', 'path': '/images/test-image'}
+        
+        first = json.loads(lambda_handler(event, {})['body'])
+        assert first['download_url'] == 'https://signed/1'
+        assert first['download_url_expires_at'] == 1000 + 3600
+        signer.generate_presigned_url.assert_called_once_with(
+            'get_object', Params={'Bucket': 'instagram-images', 'Key': 'images/sha256/abc/g1'},
+            ExpiresIn=3600
+        )
+        
+        mock_time.return_value = 1000.0 + 3000
+        assert json.loads(lambda_handler(event, {})['body'])['download_url'] == 'https://signed/1'
+        
+        # Within the refresh margin a fresh URL is signed
+        mock_time.return_value = 1000.0 + 3400
+        assert json.loads(lambda_handler(event, {})['body'])['download_url'] == 'https://signed/2'
+        assert signer.generate_presigned_url.call_count == 2
+    
     @patch('boto3.resource')
     def test_get_image_not_found(self, mock_resource):
         """Test getting non-existent image"""
@@ -345,5 +392,812 @@ class TestLambdaHandler:
         assert body['error'] == 'Not found'
 
 
+    @patch.dict(os.environ, {'METRICS_ENABLED': 'true', 'SERVER_TIMING_ENABLED': 'true'})
+    @patch('boto3.resource')
+    def test_list_images_emits_timing_metrics(self, mock_resource, capsys):
+        """Test EMF log line and Server-Timing header when metrics are enabled"""
+        mock_table = MagicMock()
+        mock_table.scan.return_value = {'Items': []}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        event = {
+            'httpMethod': 'GET',
+            'path': '/images',
+            'resource': '/images',
+            'queryStringParameters': None
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 200
+        server_timing = response['headers']['Server-Timing']
+        assert 'ddb_scan;dur=' in server_timing
+        assert 'serialize;dur=' in server_timing
+        
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert record['Route'] == 'GET /images'
+        assert record['StatusCode'] == 200
+        metric_names = [m['Name'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        assert 'ddb_scan' in metric_names
+        assert 'total' in metric_names
+        assert record['total'] >= record['ddb_scan']
+    
+    @patch.dict(os.environ, {'METRICS_ENABLED': '', 'SERVER_TIMING_ENABLED': ''})
+    @patch('boto3.resource')
+    def test_metrics_disabled(self, mock_resource, capsys):
+        """Test no metrics output or Server-Timing header when disabled"""
+        mock_table = MagicMock()
+        mock_table.scan.return_value = {'Items': []}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        event = {'httpMethod': 'GET', 'path': '/images'}
+        
+        response = lambda_handler(event, {})
+        
+        assert 'Server-Timing' not in response['headers']
+        assert capsys.readouterr().out == ''
+
+
+    @patch('boto3.resource')
+    def test_profile_header_writes_report(self, mock_resource, tmp_path):
+        """Test X-Profile header captures cProfile and tracemalloc output"""
+        mock_table = MagicMock()
+        mock_table.scan.return_value = {'Items': []}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        context = MagicMock(aws_request_id='req-123')
+        event = {
+            'httpMethod': 'GET',
+            'path': '/images',
+            'headers': {'X-Profile': '1'}
+        }
+        
+        with patch.dict(os.environ, {'PROFILE_HEADER_ENABLED': 'true',
+                                     'PROFILE_OUTPUT': str(tmp_path),
+                                     'PROFILE_TOP_N': '5'}):
+            response = lambda_handler(event, context)
+        
+        assert response['statusCode'] == 200
+        assert (tmp_path / 'req-123.prof').exists()
+        report = (tmp_path / 'req-123.txt').read_text()
+        assert 'cProfile (top 5' in report
+        assert 'tracemalloc (top 5' in report
+    
+    @patch('boto3.resource')
+    def test_profile_header_ignored_when_not_enabled(self, mock_resource, tmp_path):
+        """Test X-Profile header has no effect unless explicitly allowed"""
+        mock_table = MagicMock()
+        mock_table.scan.return_value = {'Items': []}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        event = {
+            'httpMethod': 'GET',
+            'path': '/images',
+            'headers': {'X-Profile': '1'}
+        }
+        
+        with patch.dict(os.environ, {'PROFILE_HEADER_ENABLED': '',
+                                     'PROFILE_SAMPLE_RATE': '0',
+                                     'PROFILE_OUTPUT': str(tmp_path)}):
+            response = lambda_handler(event, MagicMock(aws_request_id='req-456'))
+        
+        assert response['statusCode'] == 200
+        assert list(tmp_path.iterdir()) == []
+
+
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_upload_duplicate_skips_s3_put(self, mock_resource, mock_client):
+        """Test identical bytes are stored once under a content-addressed key"""
+        digest = '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+        tables = {'images': MagicMock(), 'image_blobs': MagicMock()}
+        tables['image_blobs'].update_item.return_value = {'Attributes': {
+            'ref_count': 2, 'state': 'committed', 'generation': 'g1',
+            's3_key': f'images/sha256/{digest}/g1'
+        }}
+        mock_resource.return_value.Table.side_effect = lambda name: tables.setdefault(name, MagicMock())
+        mock_s3_client = MagicMock()
+        mock_client.return_value = mock_s3_client
+        
+        event = {
+            'httpMethod': 'POST',
+            'path': '/images',
+            'body': json.dumps({
+                'user_id': 'test-user',
+                'filename': 'test.jpg',
+                'image_data': 'dGVzdA=='  # base64 for "test"
+            })
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 201
+        assert json.loads(response['body'])['deduplicated'] is True
+        mock_s3_client.put_object.assert_not_called()
+        
+        item = tables['images'].put_item.call_args.kwargs['Item']
+        assert item['content_hash'] == digest
+        assert item['s3_key'] == f'images/sha256/{digest}/g1'
+    
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_upload_of_pending_blob_puts_and_commits(self, mock_resource, mock_client):
+        """Test a concurrent duplicate of a not-yet-committed blob writes the object itself"""
+        tables = {'images': MagicMock(), 'image_blobs': MagicMock()}
+        tables['image_blobs'].update_item.return_value = {'Attributes': {
+            'ref_count': 2, 'state': 'pending', 'generation': 'g1', 's3_key': 'images/sha256/abc/g1'
+        }}
+        mock_resource.return_value.Table.side_effect = lambda name: tables.setdefault(name, MagicMock())
+        mock_s3_client = MagicMock()
+        mock_client.return_value = mock_s3_client
+        
+        event = {
+            'httpMethod': 'POST',
+            'path': '/images',
+            'body': json.dumps({'user_id': 'u', 'filename': 't.jpg', 'image_data': 'dGVzdA=='})
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 201
+        assert json.loads(response['body'])['deduplicated'] is False
+        assert mock_s3_client.put_object.call_args.kwargs['Key'] == 'images/sha256/abc/g1'
+        assert mock_s3_client.put_object.call_args.kwargs['CacheControl'] == 'max-age=31536000, immutable'
+        commit = tables['image_blobs'].update_item.call_args_list[1].kwargs
+        assert commit['UpdateExpression'] == 'SET #state = :committed'
+        assert tables['images'].put_item.call_args.kwargs['Item']['s3_key'] == 'images/sha256/abc/g1'
+    
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_failed_put_releases_reference(self, mock_resource, mock_client):
+        """Test a failed S3 PUT drops our reference and writes no metadata"""
+        blob = {'ref_count': 1, 'state': 'pending', 'generation': 'g1', 's3_key': 'images/sha256/abc/g1'}
+        tables = {'images': MagicMock(), 'image_blobs': MagicMock()}
+        tables['image_blobs'].update_item.side_effect = [
+            {'Attributes': blob},
+            {'Attributes': dict(blob, ref_count=0)}
+        ]
+        mock_resource.return_value.Table.side_effect = lambda name: tables.setdefault(name, MagicMock())
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'no'}}, 'PutObject'
+        )
+        mock_client.return_value = mock_s3_client
+        
+        event = {
+            'httpMethod': 'POST',
+            'path': '/images',
+            'body': json.dumps({'user_id': 'u', 'filename': 't.jpg', 'image_data': 'dGVzdA=='})
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 500
+        tables['images'].put_item.assert_not_called()
+        release = tables['image_blobs'].update_item.call_args_list[1].kwargs
+        assert release['ExpressionAttributeValues'] == {':minus_one': -1}
+        # Only this generation of the blob may be removed
+        delete = tables['image_blobs'].delete_item.call_args.kwargs
+        assert delete['ConditionExpression'] == 'ref_count <= :zero AND generation = :generation'
+        assert delete['ExpressionAttributeValues'] == {':zero': 0, ':generation': 'g1'}
+        mock_s3_client.delete_object.assert_called_once_with(
+            Bucket='instagram-images', Key='images/sha256/abc/g1'
+        )
+    
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_delete_last_reference_removes_object(self, mock_resource, mock_client):
+        """Test the shared S3 object is deleted only with its last reference"""
+        digest = '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+        stored = {
+            'image_id': 'test-image',
+            'user_id': 'test-user',
+            'filename': 'test.jpg',
+            's3_key': f'images/sha256/{digest}/g1',
+            'content_hash': digest,
+            'upload_date': '2024-01-01T00:00:00'
+        }
+        tables = {'images': MagicMock(), 'image_blobs': MagicMock()}
+        tables['images'].get_item.return_value = {'Item': stored}
+        tables['images'].delete_item.return_value = {'Attributes': stored}
+        mock_resource.return_value.Table.side_effect = lambda name: tables.setdefault(name, MagicMock())
+        mock_s3_client = MagicMock()
+        mock_client.return_value = mock_s3_client
+        event = {'httpMethod': 'DELETE', 'path': '/images/test-image'}
+        
+        # Another image still references the bytes
+        tables['image_blobs'].update_item.return_value = {
+            'Attributes': {'ref_count': 1, 's3_key': stored['s3_key'], 'generation': 'g1'}
+        }
+        assert lambda_handler(event, {})['statusCode'] == 200
+        mock_s3_client.delete_object.assert_not_called()
+        
+        # Last reference goes
+        tables['image_blobs'].update_item.return_value = {
+            'Attributes': {'ref_count': 0, 's3_key': stored['s3_key'], 'generation': 'g1'}
+        }
+        assert lambda_handler(event, {})['statusCode'] == 200
+        mock_s3_client.delete_object.assert_called_once_with(
+            Bucket='instagram-images', Key=stored['s3_key']
+        )
+    
+    @patch('src.lambda_handler._similarity_index', new_callable=SimilarityIndex)
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_similar_images(self, mock_resource, mock_client, mock_index):
+        """Test near-duplicate lookup by perceptual hash distance"""
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {
+            'Item': {'image_id': 'target', 'user_id': 'u1', 'phash': 'ff00ff00ff00ff00'}
+        }
+        # Uploads since the snapshot come from the sparse GSI
+        mock_table.query.return_value = {
+            'Items': [{'image_id': 'deleted', 'phash': 'ff00ff00ff00ff03'}]
+        }
+        mock_resource.return_value.Table.return_value = mock_table
+        mock_resource.return_value.batch_get_item.return_value = {
+            'Responses': {'images': [
+                {'image_id': 'close', 'user_id': 'u2', 'filename': 'a.jpg', 'upload_date': '2024-01-02'}
+            ]}
+        }
+        snapshot = {
+            'synced_through': datetime.now().isoformat(),
+            'hashes': {
+                'target': 'ff00ff00ff00ff00',
+                'close': 'ff00ff00ff00ff01',
+                'far': '00ff00ff00ff00ff'
+            }
+        }
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_object.return_value = {'Body': io.BytesIO(json.dumps(snapshot).encode())}
+        mock_client.return_value = mock_s3_client
+        
+        event = {
+            'httpMethod': 'GET',
+            'path': '/images/target/similar',
+            'queryStringParameters': {'max_distance': '4'}
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert [m['image_id'] for m in body['matches']] == ['close']
+        assert body['matches'][0]['distance'] == 1
+        assert len(mock_index) == 3  # 'deleted' came back empty and was dropped
+        mock_table.scan.assert_not_called()
+        assert mock_table.query.call_args.kwargs['IndexName'] == 'phash-day-index'
+    
+    @patch('src.lambda_handler._similarity_index', new_callable=SimilarityIndex)
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_similar_images_without_snapshot(self, mock_resource, mock_client, mock_index):
+        """Test a cold container never scans the table inline"""
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {
+            'Item': {'image_id': 'target', 'user_id': 'u1', 'phash': 'ff00ff00ff00ff00'}
+        }
+        mock_resource.return_value.Table.return_value = mock_table
+        mock_client.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject'
+        )
+        
+        event = {'httpMethod': 'GET', 'path': '/images/target/similar'}
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 503
+        assert json.loads(response['body'])['dependency'] == 'similarity_index'
+        mock_table.scan.assert_not_called()
+    
+    def test_similar_images_invalid_distance(self):
+        """Test max_distance is capped where multi-index lookups stay cheap"""
+        event = {
+            'httpMethod': 'GET',
+            'path': '/images/target/similar',
+            'queryStringParameters': {'max_distance': '16'}
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 400
+    
+    @patch('src.lambda_handler._similarity_index', new_callable=SimilarityIndex)
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_failed_delete_keeps_similarity_entry(self, mock_resource, mock_client, mock_index):
+        """Test the index only forgets an image once its delete succeeded"""
+        mock_index.add('test-image', 'ff00ff00ff00ff00')
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {
+            'image_id': 'test-image', 'user_id': 'u', 's3_key': 'images/u/test-image.jpg'
+        }}
+        mock_resource.return_value.Table.return_value = mock_table
+        mock_client.return_value.delete_object.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'no'}}, 'DeleteObject'
+        )
+        event = {'httpMethod': 'DELETE', 'path': '/images/test-image'}
+        
+        assert lambda_handler(event, {})['statusCode'] == 500
+        assert len(mock_index) == 1
+        
+        mock_client.return_value.delete_object.side_effect = None
+        mock_table.delete_item.return_value = {'Attributes': mock_table.get_item.return_value['Item']}
+        assert lambda_handler(event, {})['statusCode'] == 200
+        assert len(mock_index) == 0
+
+    @patch('boto3.client')
+    @patch('boto3.resource')
+    def test_upload_updates_counters(self, mock_resource, mock_client):
+        """Test upload increments the user counter, facets and each distinct tag's shard"""
+        tables = {}
+        mock_resource.return_value.Table.side_effect = lambda name: tables.setdefault(name, MagicMock())
+        
+        event = {
+            'httpMethod': 'POST',
+            'path': '/images',
+            'body': json.dumps({
+                'user_id': 'alice',
+                'filename': 'beach.jpg',
+                'image_data': 'dGVzdA==',
+                'tags': ['beach', 'sun', 'beach']
+            })
+        }
+        
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 201
+        calls = [c.kwargs for c in tables['image_stats'].update_item.call_args_list]
+        keys = [c['Key']['stat_key'] for c in calls]
+        assert keys[:2] == ['user#alice', 'usertags#alice']
+        assert keys[2].startswith('tagfreq#beach#') and keys[3].startswith('tagfreq#sun#')
+        assert keys[4].startswith('tagrecent#')
+        
+        # The user's count is its own update, so facet growth can never block it
+        assert calls[0]['UpdateExpression'] == 'ADD image_count :delta'
+        assert calls[1]['UpdateExpression'] == 'ADD #t0 :delta, #t1 :delta'
+        assert calls[1]['ExpressionAttributeNames'] == {'#t0': 'tag:beach', '#t1': 'tag:sun'}
+        assert all(c['ExpressionAttributeValues'] == {':delta': 1} for c in calls[:4])
+        assert calls[2]['UpdateExpression'] == 'ADD image_count :delta'
+        assert calls[4]['ExpressionAttributeValues'][':tags'] == {'beach', 'sun'}
+    
+    @patch.dict(os.environ, {'TAG_SHARDS': '3'})
+    @patch('boto3.resource')
+    def test_user_and_tag_stats(self, mock_resource):
+        """Test stats endpoints read a user counter or sum a tag's shards"""
+        mock_table = MagicMock()
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        mock_table.get_item.return_value = {'Item': {'image_count': 42}}
+        response = lambda_handler({'httpMethod': 'GET', 'path': '/users/alice/stats'}, {})
+        assert response['statusCode'] == 200
+        assert json.loads(response['body']) == {'user_id': 'alice', 'image_count': 42}
+        mock_table.get_item.assert_called_with(
+            Key={'stat_key': 'user#alice'}, ProjectionExpression='image_count'
+        )
+        
+        mock_resource.return_value.batch_get_item.return_value = {'Responses': {'image_stats': [
+            {'stat_key': 'tagfreq#new york#0', 'image_count': 2},
+            {'stat_key': 'tagfreq#new york#2', 'image_count': 3}
+        ]}}
+        response = lambda_handler({'httpMethod': 'GET', 'path': '/tags/new%20york/stats'}, {})
+        assert json.loads(response['body']) == {'tag': 'new york', 'image_count': 5}
+        request = mock_resource.return_value.batch_get_item.call_args.kwargs['RequestItems']
+        assert [k['stat_key'] for k in request['image_stats']['Keys']] == [
+            'tagfreq#new york#0', 'tagfreq#new york#1', 'tagfreq#new york#2'
+        ]
+    
+    def test_reconcile_stats_repairs_drift(self):
+        """Test reconciliation fixes only drift the previous run also saw"""
+        images = MagicMock()
+        images.scan.return_value = {'Items': [
+            {'user_id': 'alice', 'tags': ['beach']},
+            {'user_id': 'alice', 'tags': ['beach', 'sun']},
+            {'user_id': 'bob', 'tags': []}
+        ]}
+        stats = MagicMock()
+        stats.scan.return_value = {'Items': [
+            {'stat_key': 'user#alice', 'image_count': 2},
+            {'stat_key': 'usertags#alice', 'tag:beach': 2, 'tag:sun': 1},
+            {'stat_key': 'user#bob', 'image_count': 3},
+            {'stat_key': 'usertags#bob', 'tag:gone': 1},
+            {'stat_key': 'tagfreq#beach#3', 'image_count': 1},
+            {'stat_key': 'tagfreq#beach#7', 'image_count': 2},
+            {'stat_key': 'tagfreq#sun#1', 'image_count': 1},
+            {'stat_key': 'tagrecent#480000#1', 'tags': {'beach'}}
+        ]}
+        stats.get_item.return_value = {'Item': {'stat_key': 'reconcile#state', 'drift': {
+            'usertags#bob|tag:gone': [1, 0],
+            'user#bob|image_count': [3, 1],
+            'tagfreq#beach|image_count': [3, 2]
+        }}}
+        dynamodb = MagicMock()
+        dynamodb.Table.side_effect = lambda name: {'images': images, 'image_stats': stats}[name]
+        
+        result = reconcile_stats(dynamodb)
+        
+        assert result['images_checked'] == 3
+        assert result['pending'] == []
+        assert result['fixed'] == [
+            {'stat_key': 'user#bob', 'attribute': 'image_count', 'observed': 3, 'expected': 1},
+            {'stat_key': 'usertags#bob', 'attribute': 'tag:gone', 'observed': 1, 'expected': 0},
+            {'stat_key': 'tagfreq#beach', 'attribute': 'image_count', 'observed': 3, 'expected': 2}
+        ]
+        updates = [c.kwargs for c in stats.update_item.call_args_list]
+        assert updates[2] == {
+            'Key': {'stat_key': 'tagfreq#beach#0'},
+            'UpdateExpression': 'ADD image_count :drift',
+            'ExpressionAttributeValues': {':drift': -1}
+        }
+        # The exact recount also replaces the top tags ranking
+        stored = [c.kwargs['Item'] for c in stats.put_item.call_args_list]
+        assert stored[0]['drift'] == {}
+        assert stored[1]['stat_key'] == 'top_tags#global'
+        assert stored[1]['tags'] == [['beach', 2], ['sun', 1]]
+    
+    def test_reconcile_ignores_upload_racing_the_recount(self):
+        """Test an upload landing between the two scans is never corrected away"""
+        state = {}
+        stats = MagicMock()
+        stats.get_item.side_effect = lambda Key: {'Item': state} if state else {}
+        stats.put_item.side_effect = lambda Item: state.update(Item)
+        images = MagicMock()
+        dynamodb = MagicMock()
+        dynamodb.Table.side_effect = lambda name: {'images': images, 'image_stats': stats}[name]
+        
+        # Run 1: counters are read, then an upload lands before images are counted
+        stats.scan.return_value = {'Items': [{'stat_key': 'user#alice', 'image_count': 1}]}
+        images.scan.return_value = {'Items': [{'user_id': 'alice'}, {'user_id': 'alice'}]}
+        result = reconcile_stats(dynamodb)
+        assert result['fixed'] == []
+        assert len(result['pending']) == 1
+        
+        # Run 2: the upload's ADD has landed and everything agrees
+        stats.scan.return_value = {'Items': [{'stat_key': 'user#alice', 'image_count': 2}]}
+        result = reconcile_stats(dynamodb)
+        assert result['fixed'] == [] and result['pending'] == []
+        stats.update_item.assert_not_called()
+        
+        # Real drift persists across two runs and is then repaired
+        stats.scan.return_value = {'Items': [{'stat_key': 'user#alice', 'image_count': 5}]}
+        assert reconcile_stats(dynamodb)['fixed'] == []
+        assert len(reconcile_stats(dynamodb)['fixed']) == 1
+        assert stats.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':want': 2, ':have': 5}
+    
+    @patch.dict(os.environ, {'TAG_SHARDS': '2'})
+    @patch('src.lambda_handler._top_tags_cache', {'tags': None, 'refreshed_at': 0, 'loaded_at': 0.0})
+    @patch('boto3.resource')
+    def test_top_tags_refresh_recounts_only_touched_tags(self, mock_resource):
+        """Test a stale ranking is updated from recently touched tags, not every tag"""
+        import time
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {
+            'stat_key': 'top_tags#global',
+            'tags': [['beach', 5], ['city', 4], ['sun', 1]],
+            'refreshed_at': int(time.time()) - 3600
+        }}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        def batch_get(RequestItems):
+            keys = [k['stat_key'] for k in RequestItems['image_stats']['Keys']]
+            if keys[0].startswith('tagrecent#'):
+                items = [{'stat_key': keys[0], 'tags': {'sun', 'food'}}]
+            else:
+                assert sorted(keys) == ['tagfreq#food#0', 'tagfreq#food#1', 'tagfreq#sun#0', 'tagfreq#sun#1']
+                items = [
+                    {'stat_key': 'tagfreq#sun#0', 'image_count': 3},
+                    {'stat_key': 'tagfreq#sun#1', 'image_count': 3},
+                    {'stat_key': 'tagfreq#food#1', 'image_count': 2}
+                ]
+            return {'Responses': {'image_stats': items}}
+        mock_resource.return_value.batch_get_item.side_effect = batch_get
+        
+        event = {'httpMethod': 'GET', 'path': '/tags/top', 'queryStringParameters': {'k': '2'}}
+        response = lambda_handler(event, {})
+        
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert body['tags'] == [{'tag': 'sun', 'count': 6}, {'tag': 'beach', 'count': 5}]
+        stored = mock_table.put_item.call_args.kwargs['Item']
+        assert stored['stat_key'] == 'top_tags#global'
+        assert stored['tags'] == [['sun', 6], ['beach', 5], ['city', 4], ['food', 2]]
+        
+        # Warm invocations serve the cached list without touching DynamoDB
+        mock_table.reset_mock()
+        mock_resource.return_value.batch_get_item.reset_mock()
+        response = lambda_handler(event, {})
+        assert json.loads(response['body'])['tags'][0] == {'tag': 'sun', 'count': 6}
+        mock_table.get_item.assert_not_called()
+        mock_resource.return_value.batch_get_item.assert_not_called()
+    
+    @patch('boto3.resource')
+    def test_top_tags_for_user(self, mock_resource):
+        """Test user-scoped top tags come from the user's facet item"""
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {'Item': {
+            'stat_key': 'usertags#alice', 'tag:beach': 2, 'tag:food': 7, 'tag:gone': 0
+        }}
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        event = {
+            'httpMethod': 'GET',
+            'path': '/tags/top',
+            'queryStringParameters': {'k': '5', 'user_id': 'alice'}
+        }
+        response = lambda_handler(event, {})
+        
+        body = json.loads(response['body'])
+        assert body['tags'] == [{'tag': 'food', 'count': 7}, {'tag': 'beach', 'count': 2}]
+        assert body['user_id'] == 'alice'
+        mock_table.get_item.assert_called_with(Key={'stat_key': 'usertags#alice'})
+    
+    @patch.dict(os.environ, {'METRICS_ENABLED': 'true'})
+    @patch('boto3.resource')
+    def test_throttling_returns_503(self, mock_resource, capsys):
+        """Test throttling that outlasts retries is a 503 with Retry-After, not an empty 200"""
+        mock_table = MagicMock()
+        mock_table.scan.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'},
+             'ResponseMetadata': {'RetryAttempts': 3}},
+            'Scan'
+        )
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        response = lambda_handler({'httpMethod': 'GET', 'path': '/images'}, {})
+        
+        assert response['statusCode'] == 503
+        assert response['headers']['Retry-After'] == '1'
+        assert json.loads(response['body'])['dependency'] == 'dynamodb'
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert record['aws_throttles'] == 1
+        assert record['aws_retries'] == 3
+    
+    @patch.dict(os.environ, {'CIRCUIT_FAILURE_THRESHOLD': '2', 'CIRCUIT_RESET_SECONDS': '30'})
+    @patch('boto3.resource')
+    def test_circuit_opens_after_repeated_throttling(self, mock_resource):
+        """Test an open circuit fails fast without calling DynamoDB"""
+        mock_table = MagicMock()
+        mock_table.get_item.side_effect = ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'GetItem'
+        )
+        mock_resource.return_value.Table.return_value = mock_table
+        event = {'httpMethod': 'GET', 'path': '/images/test-image'}
+        
+        for _ in range(2):
+            assert lambda_handler(event, {})['statusCode'] == 503
+        
+        response = lambda_handler(event, {})
+        assert response['statusCode'] == 503
+        assert 'circuit open' in json.loads(response['body'])['error']
+        assert int(response['headers']['Retry-After']) >= 1
+        assert mock_table.get_item.call_count == 2
+
+
+    @patch.dict(os.environ, {'METRICS_ENABLED': 'true'})
+    def test_unmatched_route_has_fixed_metrics_label(self, capsys):
+        """Test 404 probe paths do not create new metric series"""
+        response = lambda_handler({'httpMethod': 'GET', 'path': '/wp-login.php'}, {})
+        
+        assert response['statusCode'] == 404
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert record['Route'] == 'GET unmatched'
+
+
+    @patch('boto3.resource')
+    def test_profile_output_is_capped(self, mock_resource, tmp_path):
+        """Test bad numeric settings fall back to defaults and old profiles are pruned"""
+        mock_table = MagicMock()
+        mock_table.scan.return_value = {'Items': []}
+        mock_resource.return_value.Table.return_value = mock_table
+        event = {'httpMethod': 'GET', 'path': '/images', 'headers': {'x-profile': '1'}}
+        
+        with patch.dict(os.environ, {'PROFILE_HEADER_ENABLED': 'true',
+                                     'PROFILE_OUTPUT': str(tmp_path),
+                                     'PROFILE_TOP_N': 'lots',
+                                     'PROFILE_TRACEMALLOC_FRAMES': '',
+                                     'PROFILE_MAX_FILES': '2'}):
+            for i in range(4):
+                response = lambda_handler(event, MagicMock(aws_request_id=f'req-{i}'))
+                assert response['statusCode'] == 200
+                os.utime(tmp_path / f'req-{i}.prof', (1000 + i, 1000 + i))
+        
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            'req-2.prof', 'req-2.txt', 'req-3.prof', 'req-3.txt'
+        ]
+
+
+class TestResilience:
+    
+    @patch.dict(os.environ, {'CIRCUIT_FAILURE_THRESHOLD': '1', 'CIRCUIT_RESET_SECONDS': '30'})
+    def test_circuit_breaker_half_open(self):
+        """Test one trial call after the cool-down; success closes, failure re-opens"""
+        breaker = CircuitBreaker('dynamodb')
+        with patch('time.time', return_value=1000.0):
+            breaker.record_failure()
+            with pytest.raises(ServiceUnavailable):
+                breaker.before_call()
+        
+        with patch('time.time', return_value=1031.0):
+            breaker.before_call()  # trial call allowed
+            with pytest.raises(ServiceUnavailable):
+                breaker.before_call()  # only one trial at a time
+            breaker.record_failure()
+            with pytest.raises(ServiceUnavailable):
+                breaker.before_call()  # re-opened
+        
+        with patch('time.time', return_value=1062.0):
+            breaker.before_call()
+            breaker.record_success()
+            breaker.before_call()
+            breaker.before_call()  # closed again
+    
+    @patch('time.sleep')
+    def test_batch_get_retries_unprocessed_keys(self, mock_sleep):
+        """Test partially throttled batch reads are retried with backoff"""
+        dynamodb = MagicMock()
+        dynamodb.batch_get_item.side_effect = [
+            {'Responses': {'images': [{'image_id': 'a'}]},
+             'UnprocessedKeys': {'images': {'Keys': [{'image_id': 'b'}]}}},
+            {'Responses': {'images': [{'image_id': 'b'}]}, 'UnprocessedKeys': {}}
+        ]
+        
+        items = _batch_get_items(dynamodb, 'images', [{'image_id': 'a'}, {'image_id': 'b'}])
+        
+        assert [item['image_id'] for item in items] == ['a', 'b']
+        assert dynamodb.batch_get_item.call_args_list[1].kwargs['RequestItems'] == {
+            'images': {'Keys': [{'image_id': 'b'}]}
+        }
+        mock_sleep.assert_called_once()
+
+
+class FakeS3:
+    """Just enough of S3 for exports: objects plus multipart uploads"""
+    
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+    
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.encode()
+    
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+    
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f'upload-{len(self.uploads)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+    
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+    
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+
+class TestExport:
+    
+    def _pages(self):
+        items = [{'image_id': f'img-{i}', 'tags': ['a'], 'size': Decimal(i)} for i in range(9)]
+        return [
+            {'Items': items[0:3], 'LastEvaluatedKey': {'image_id': 'img-2'}},
+            {'Items': items[3:6], 'LastEvaluatedKey': {'image_id': 'img-5'}},
+            {'Items': items[6:9]}
+        ], items
+    
+    @patch('src.lambda_handler._MIN_PART_BYTES', 1)
+    @patch.dict(os.environ, {'EXPORT_PART_BYTES': '1'})
+    def test_export_streams_gzip_parts(self):
+        """Test each scan page becomes a gzip member and the object decodes as NDJSON"""
+        pages, items = self._pages()
+        dynamodb = MagicMock()
+        dynamodb.Table.return_value.scan.side_effect = pages
+        s3 = FakeS3()
+        
+        state = export_catalog(dynamodb, s3, 'exp1')
+        
+        assert state['status'] == 'complete'
+        assert state['items'] == 9
+        assert len(state['parts']) == 3
+        lines = gzip.decompress(s3.objects['exports/exp1/part-0000.ndjson.gz']).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            dict(item, size=int(item['size'])) for item in items
+        ]
+    
+    @patch('src.lambda_handler._MIN_PART_BYTES', 1)
+    @patch.dict(os.environ, {'EXPORT_PART_BYTES': '1'})
+    def test_export_resumes_from_checkpoint(self):
+        """Test an export stopped by its deadline continues where it left off"""
+        pages, items = self._pages()
+        dynamodb = MagicMock()
+        scan = dynamodb.Table.return_value.scan
+        scan.side_effect = pages[:1]
+        s3 = FakeS3()
+        
+        state = export_catalog(dynamodb, s3, 'exp2', compress=False, deadline=0)
+        assert state['status'] == 'running'
+        assert state['start_key'] == {'image_id': 'img-2'}
+        
+        scan.side_effect = pages[1:]
+        state = export_catalog(dynamodb, s3, 'exp2', compress=False)
+        
+        assert scan.call_args_list[1].kwargs == {'ExclusiveStartKey': {'image_id': 'img-2'}}
+        assert state['status'] == 'complete'
+        lines = s3.objects['exports/exp2/part-0000.ndjson'].splitlines()
+        assert [json.loads(line)['image_id'] for line in lines] == [item['image_id'] for item in items]
+        
+        # Running it again is a no-op
+        assert export_catalog(dynamodb, s3, 'exp2', compress=False)['status'] == 'complete'
+        assert scan.call_count == 3
+    
+    @patch('boto3.client')
+    def test_export_api(self, mock_client):
+        """Test POST /exports fans out one background job per segment and GET reports progress"""
+        s3 = FakeS3()
+        lambda_client = MagicMock()
+        mock_client.side_effect = lambda service, **kwargs: lambda_client if service == 'lambda' else s3
+        
+        response = lambda_handler({
+            'httpMethod': 'POST', 'path': '/exports', 'body': json.dumps({'segments': 4})
+        }, {})
+        
+        assert response['statusCode'] == 202
+        export_id = json.loads(response['body'])['export_id']
+        payloads = [json.loads(c.kwargs['Payload']) for c in lambda_client.invoke.call_args_list]
+        assert [p['segment'] for p in payloads] == [0, 1, 2, 3]
+        assert all(c.kwargs['InvocationType'] == 'Event' for c in lambda_client.invoke.call_args_list)
+        
+        status = json.loads(lambda_handler({'httpMethod': 'GET', 'path': f'/exports/{export_id}'}, {})['body'])
+        assert status['status'] == 'running'
+        assert [seg['status'] for seg in status['segments']] == ['pending'] * 4
+        
+        assert lambda_handler({'httpMethod': 'GET', 'path': '/exports/unknown'}, {})['statusCode'] == 404
+        bad = lambda_handler({'httpMethod': 'POST', 'path': '/exports', 'body': '{"segments": 0}'}, {})
+        assert bad['statusCode'] == 400
+
+
+class TestSimilarityIndex:
+    
+    def test_multi_index_matches_brute_force(self):
+        """Test multi-index range queries return exactly the brute-force matches"""
+        import random
+        rng = random.Random(42)
+        values = [rng.getrandbits(64) for _ in range(2000)]
+        # Plant near neighbours so every radius has something to find
+        values += [values[i] ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for i in range(200)]
+        index = MultiIndexHash()
+        for i, value in enumerate(values):
+            index.add(value, i)
+        
+        for query in values[:20]:
+            for radius in (0, 3, 4, 15):
+                expected = sorted((bin(query ^ v).count('1'), i) for i, v in enumerate(values)
+                                  if bin(query ^ v).count('1') <= radius)
+                assert sorted(index.search(query, radius)) == expected
+        
+        index.remove(0)
+        assert all(key != 0 for _, key in index.search(values[0], 15))
+    
+    def test_dhash_stable_under_resize(self):
+        """Test dHash is close for a resized copy of the same image"""
+        Image = pytest.importorskip('PIL.Image')
+        import io
+        
+        original = Image.linear_gradient('L').rotate(30).convert('RGB')
+        encoded = []
+        for size in ((256, 256), (97, 97)):
+            buffer = io.BytesIO()
+            original.resize(size).save(buffer, format='JPEG')
+            encoded.append(buffer.getvalue())
+        
+        first, second = (int(compute_dhash(data), 16) for data in encoded)
+        assert bin(first ^ second).count('1') <= 6
+        assert compute_dhash(b'not an image') is None
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
\ No newline at end of file